@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import json
+from backupfile import encode
+
+#Structural comparison of backups (links by sender and receiver, paramsets by content)
+
+KINDS = ['added', 'removed', 'changed']
+
+def paramset_changes(old, new):
+    '''
+        Returns dict of (old value, new value) by parameter name of all parameters which differ
+        between the paramsets <old> and <new> (None is an empty paramset)
+    '''
+    old = old or dict()
+    new = new or dict()
+    if old == new:
+        return dict()
+    return dict( (k, (old.get(k), new.get(k))) for k in set(old) | set(new) if old.get(k) != new.get(k) )
+
+def link_index(backup):
+    '''
+        Links of <backup> by (sender, receiver). Entries marked for deletion are not part of the index.
+    '''
+    return dict( ((l['sender'], l['receiver']), l) for l in backup['Linklist'] if not l['delete'] )
+
+def diff_links(old_links, new_links, old_paramset, new_paramset):
+    '''
+        Compares the link entries <old_links> and <new_links> (dicts by (sender, receiver)).
+        old_paramset, new_paramset: functions returning the paramset of a psetid
+        Every pair of paramset ids is compared only once.
+        Returns list of (change, old link, new link, changed keys) sorted by sender and receiver with change
+        one of "added", "removed" or "changed" and changed keys as dict of (old value, new value) by parameter name.
+    '''
+    changes = list()
+    compared = dict()
+    for key in sorted(set(old_links) | set(new_links)):
+        o = old_links.get(key)
+        n = new_links.get(key)
+        if o is None:
+            changes.append( ('added', None, n, None) )
+        elif n is None:
+            changes.append( ('removed', o, None, None) )
+        else:
+            ids = (unicode(o['psetid']), unicode(n['psetid']))
+            if ids not in compared:
+                compared[ids] = paramset_changes(old_paramset(ids[0]), new_paramset(ids[1]))
+            if compared[ids]:
+                changes.append( ('changed', o, n, compared[ids]) )
+    return changes
+
+def diff_backups(old, new):
+    '''
+        Changes of the links from backup <old> to backup <new> (dicts with Linklist and Paramsets)
+    '''
+    return diff_links(link_index(old), link_index(new), old['Paramsets'].get, new['Paramsets'].get)
+
+def count(changes):
+    return tuple(len([c for c in changes if c[0] == kind]) for kind in KINDS)
+
+def report(changes):
+    '''
+        Machine readable report of <changes> (JSON serializable dict)
+    '''
+    result = dict( (kind, list()) for kind in KINDS )
+    for change, old, new, keys in changes:
+        link = new or old
+        entry = {'sender':link['sender'], 'receiver':link['receiver'], 'desc':link.get('desc', '').strip()}
+        if change == 'changed':
+            entry['old_psetid'] = old['psetid']
+            entry['new_psetid'] = new['psetid']
+            entry['keys'] = dict( (k, {'old':v[0], 'new':v[1]}) for k, v in keys.iteritems() )
+        else:
+            entry['psetid'] = link['psetid']
+        result[change].append(entry)
+    result['summary'] = dict(zip(KINDS, count(changes)))
+    return result
+
+def print_changes(changes, fd):
+    '''
+        Writes a compact human readable report of <changes> to <fd>
+    '''
+    signs = {'added':'+', 'removed':'-', 'changed':'~'}
+    for change, old, new, keys in changes:
+        link = new or old
+        fd.write(encode(u'%s %s -> %s  %s\n'%(signs[change], link['sender'], link['receiver'], link.get('desc', '').strip())))
+        if change == 'changed':
+            for k in sorted(keys):
+                fd.write('      %s: %r -> %r\n'%(k, keys[k][0], keys[k][1]))
+    fd.write('%d added, %d removed, %d changed\n'%count(changes))
+
+def write_report(changes, fd, as_json=False):
+    if as_json:
+        json.dump(report(changes), fd, indent=1, sort_keys=True)
+        fd.write('\n')
+    else:
+        print_changes(changes, fd)
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import tempfile
+import logging as log
+
+#Reading and writing of link backup files
+
+SECTIONS = ['Linklist', 'Paramsets', 'Devices']
+
+def load_backup(filename):
+    '''
+        Reads the backup file <filename>. Raises EnvironmentError if it is not valid JSON.
+    '''
+    with open(filename) as fd:
+        try:
+            return json.load(fd)
+        except ValueError, e:
+            msg = 'Error while reading file %s: %s'%(filename, e)
+            log.error(msg)
+            raise EnvironmentError(msg)
+
+def scan_backup(fd):
+    '''
+        Iterates the lines of a backup file with one link per line (as written by BackupWriter).
+        Yields (section, offset, length, text) of every entry line. text is the entry without
+        indentation and trailing comma. Section headers are not indented, entries are.
+    '''
+    section = None
+    offset = 0
+    for line in fd:
+        if not line.startswith(' '):
+            for name in SECTIONS:
+                if '"%s"'%name in line:
+                    section = name
+        else:
+            text = line.strip().rstrip(',')
+            if text:
+                yield section, offset, len(line), text
+        offset += len(line)
+
+def parse_keyed_entry(text):
+    '''
+        Splits an entry line "key":{...} of the Paramsets or Devices section into key and value
+    '''
+    key = text[1:text.index('"', 1)]
+    return key, json.loads(text[len(key)+3:])
+
+class LazyParamsets(object):
+    '''
+        Read only dict of the paramsets of a backup file by psetid. A paramset is read from the file
+        when it is used for the first time and kept afterwards, so only referenced paramsets are loaded.
+        fd: backup file opened for reading
+        offsets: dict of (offset, length) of the paramset lines by psetid
+    '''
+    def __init__(self, fd, offsets):
+        self.fd = fd
+        self.offsets = offsets
+        self.loaded = dict()
+    def __getitem__(self, psetid):
+        if psetid not in self.loaded:
+            offset, length = self.offsets[psetid]
+            self.fd.seek(offset)
+            self.loaded[psetid] = parse_keyed_entry(self.fd.read(length).strip().rstrip(','))[1]
+        return self.loaded[psetid]
+    def get(self, psetid, default=None):
+        try:
+            return self[psetid]
+        except KeyError:
+            return default
+    def __contains__(self, psetid):
+        return psetid in self.offsets
+    def __len__(self):
+        return len(self.offsets)
+
+class BackupReader(object):
+    '''
+        Reads a backup file with one link per line without loading it completely.
+        links() iterates the link entries in file order, paramsets is a LazyParamsets table.
+        Only the offsets of the paramset lines are kept in memory. A file in another layout
+        (e.g. formatted by an editor) is loaded completely.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = open(filename, 'rb')
+        self.backup = None
+        if self.fd.readline().strip() != '{"Linklist": [':
+            log.warn('Backup file "%s" is not in the one link per line layout. Loading it completely', filename)
+            self.backup = load_backup(filename)
+            self.paramsets = self.backup['Paramsets']
+            return
+        self.fd.seek(0)
+        offsets = dict()
+        for section, offset, length, text in scan_backup(self.fd):
+            if section == 'Paramsets' and text.startswith('"'):
+                offsets[text[1:text.index('"', 1)]] = (offset, length)
+        self.paramsets = LazyParamsets(self.fd, offsets)
+    def links(self):
+        '''
+            Iterates the link entries of the backup file
+        '''
+        if self.backup is not None:
+            for link in self.backup['Linklist']:
+                yield link
+            return
+        with open(self.filename, 'rb') as fd:
+            for section, offset, length, text in scan_backup(fd):
+                if section == 'Paramsets':
+                    break
+                if section == 'Linklist' and text.startswith('{'):
+                    try:
+                        yield json.loads(text)
+                    except ValueError, e:
+                        msg = 'Error while reading file %s at offset %d: %s'%(self.filename, offset, e)
+                        log.error(msg)
+                        raise EnvironmentError(msg)
+    def close(self):
+        self.fd.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+def link_sortkey(link):
+    '''
+        Order of the links in a backup file: by paramset id, description and addresses
+    '''
+    return (link['psetid'], link['desc'], link['sender'], link['receiver'])
+
+def encode(data):
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    return data
+
+class BackupWriter(object):
+    '''
+        Streams a backup file with one link per line to disk.
+        The data is written to a temporary file next to <filename> which replaces <filename>
+        only when close() is called. An interrupted backup never leaves a truncated file.
+
+        Usage:
+        with BackupWriter(filename) as writer:
+            for link in links:
+                writer.write_link(link)
+            writer.write_paramsets(paramsets)
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        path = os.path.dirname(os.path.abspath(filename))
+        fd, self.tmpname = tempfile.mkstemp(prefix='.%s.'%os.path.basename(filename), suffix='.tmp', dir=path)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.tmpname, 0666 & ~umask)
+        self.fd = os.fdopen(fd, 'w')
+        self.fd.write('{"Linklist": [ \n')
+        self.nlinks = 0
+        self.links_closed = False
+        self.paramsets_written = False
+        self.devices_written = False
+    def write_link(self, link):
+        '''
+            link: dict of one link with reference to a paramset
+        '''
+        if self.nlinks > 0:
+            self.fd.write(',\n')
+        self.fd.write('    ')
+        self.fd.write(encode(json.dumps(link, ensure_ascii=False)))
+        self.nlinks += 1
+    def close_links(self):
+        if not self.links_closed:
+            self.fd.write('\n],')
+            self.links_closed = True
+    def write_paramsets(self, paramsets):
+        '''
+            paramsets: dict of paramsets by reference. They are written sorted by reference.
+        '''
+        self.close_links()
+        self.fd.write('"Paramsets": { \n')
+        first = True
+        for key in sorted(paramsets):
+            if not first:
+                self.fd.write(',\n')
+            first = False
+            self.fd.write(encode(u'    "%s":'%key))
+            self.fd.write(encode(json.dumps(paramsets[key], ensure_ascii=False)))
+        self.fd.write('\n}')
+        self.paramsets_written = True
+    def write_devices(self, devices):
+        '''
+            devices: dict of device metadata by address. Written after the paramsets.
+        '''
+        if not self.paramsets_written:
+            self.write_paramsets(dict())
+        self.fd.write(',\n"Devices": { \n')
+        first = True
+        for addr in sorted(devices):
+            if not first:
+                self.fd.write(',\n')
+            first = False
+            self.fd.write(encode(u'    "%s":'%addr))
+            self.fd.write(encode(json.dumps(devices[addr], ensure_ascii=False)))
+        self.fd.write('\n}')
+        self.devices_written = True
+    def close(self):
+        '''
+            Finishes the file and moves it to its final location
+        '''
+        if not self.paramsets_written:
+            self.write_paramsets(dict())
+        self.fd.write('}')
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+        self.fd.close()
+        os.rename(self.tmpname, self.filename)
+        log.debug('Wrote %d links to "%s"', self.nlinks, self.filename)
+    def abort(self):
+        '''
+            Discards the temporary file. An existing file <filename> is left untouched.
+        '''
+        self.fd.close()
+        os.remove(self.tmpname)
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import re
+import sqlite3
+import logging as log
+from backupfile import parse_keyed_entry, scan_backup
+
+#SQLite index next to a backup file for reading selected links without loading the whole file
+
+INDEX_VERSION = 1
+
+def index_filename(filename):
+    return filename + '.idx'
+
+def serial(addr):
+    return addr.split(':')[0]
+
+class BackupIndex(object):
+    '''
+        Index of the links and paramsets of a backup file with one link per line.
+        Stores the byte offset of every link and paramset line together with sender, receiver,
+        their serial numbers, psetid, endpoint and description. The index is rebuilt when size
+        or modification time of the backup file change.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(index_filename(filename))
+        self.db.create_function('REGEXP', 2, lambda pattern, value: value is not None and re.search(pattern, value, re.UNICODE) is not None)
+        if not self.is_current():
+            self.build()
+    def stamp(self):
+        st = os.stat(self.filename)
+        return '%d:%r:%d'%(INDEX_VERSION, st.st_mtime, st.st_size)
+    def is_current(self):
+        try:
+            row = self.db.execute("SELECT value FROM meta WHERE key='stamp'").fetchone()
+        except sqlite3.Error:
+            return False
+        return row is not None and row[0] == self.stamp()
+    def build(self):
+        log.info('Building index of backup file "%s"', self.filename)
+        db = self.db
+        db.executescript('''
+            DROP TABLE IF EXISTS meta;
+            DROP TABLE IF EXISTS links;
+            DROP TABLE IF EXISTS paramsets;
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE links (offset INTEGER, length INTEGER, sender TEXT, receiver TEXT, sender_serial TEXT,
+                                receiver_serial TEXT, psetid TEXT, iface TEXT, desc TEXT);
+            CREATE TABLE paramsets (psetid TEXT PRIMARY KEY, offset INTEGER, length INTEGER);
+        ''')
+        links = list()
+        paramsets = list()
+        with open(self.filename, 'rb') as fd:
+            for section, offset, length, text in scan_backup(fd):
+                if section == 'Linklist' and text.startswith('{'):
+                    l = self.parse(text, offset)
+                    links.append( (offset, length, l['sender'], l['receiver'], serial(l['sender']), serial(l['receiver']),
+                                   unicode(l['psetid']), l.get('iface'), l.get('desc')) )
+                elif section == 'Paramsets' and text.startswith('"'):
+                    psetid = text[1:text.index('"', 1)]
+                    paramsets.append( (psetid, offset, length) )
+        db.executemany('INSERT INTO links VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', links)
+        db.executemany('INSERT INTO paramsets VALUES (?, ?, ?)', paramsets)
+        for column in ['sender', 'receiver', 'sender_serial', 'receiver_serial', 'psetid']:
+            db.execute('CREATE INDEX links_%s ON links (%s)'%(column, column))
+        db.execute("INSERT INTO meta VALUES ('stamp', ?)", (self.stamp(),))
+        db.commit()
+        log.info('Indexed %d links and %d paramsets', len(links), len(paramsets))
+    def parse(self, text, offset):
+        try:
+            return json.loads(text)
+        except ValueError, e:
+            msg = 'Backup file "%s" is not in the one link per line layout (offset %d): %s'%(self.filename, offset, e)
+            log.error(msg)
+            raise EnvironmentError(msg)
+    def read(self, fd, offset, length):
+        fd.seek(offset)
+        return fd.read(length).strip().rstrip(',')
+    def select(self, devices=None, name_pattern=None, psetids=None):
+        '''
+            Reads the links matching all given filters and the paramsets referenced by them.
+            devices: list of addresses or serial numbers. Links with one of them as sender or receiver match.
+            name_pattern: regular expression searched in the description (names) of the link
+            psetids: list of paramset references
+            Returns a backup dict with Linklist and Paramsets like load_backup.
+        '''
+        where = list()
+        args = list()
+        if devices:
+            marks = ', '.join('?'*len(devices))
+            where.append('(sender IN (%s) OR receiver IN (%s) OR sender_serial IN (%s) OR receiver_serial IN (%s))'%((marks,)*4))
+            args.extend(list(devices)*4)
+        if name_pattern:
+            where.append('desc REGEXP ?')
+            args.append(name_pattern)
+        if psetids:
+            where.append('psetid IN (%s)'%', '.join('?'*len(psetids)))
+            args.extend(psetids)
+        query = 'SELECT offset, length FROM links'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        rows = self.db.execute(query + ' ORDER BY offset', args).fetchall()
+
+        backup = {'Linklist':list(), 'Paramsets':dict()}
+        with open(self.filename, 'rb') as fd:
+            for offset, length in rows:
+                backup['Linklist'].append(self.parse(self.read(fd, offset, length), offset))
+            ids = sorted(set(unicode(l['psetid']) for l in backup['Linklist']))
+            for psetid in ids:
+                row = self.db.execute('SELECT offset, length FROM paramsets WHERE psetid=?', (psetid,)).fetchone()
+                if row is None:
+                    continue
+                backup['Paramsets'][psetid] = parse_keyed_entry(self.read(fd, row[0], row[1]))[1]
+        log.info('Selected %d links and %d paramsets from index', len(backup['Linklist']), len(backup['Paramsets']))
+        return backup
+    def close(self):
+        self.db.close()
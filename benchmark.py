@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+import xmlrpclib
+import logging as log
+
+import fakeccu
+import hmnet
+import hmbackup
+from backupfile import BackupWriter, load_backup
+
+#Measures backup and restore throughput against a simulated CCU (fakeccu.py)
+
+NAME_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'homematic_manager_names.json')
+
+def serve(options, links, queue):
+    ccu = fakeccu.FakeCCU(links, options.links_per_receiver, options.paramsets, options.latency, options.call_latency)
+    server = fakeccu.FakeCCUServer(ccu, '127.0.0.1', 0)
+    queue.put(server.server_address[1])
+    server.serve_forever()
+
+def run_operation(operation, rpcaddress, options, workdir, queue):
+    '''
+        Executes <operation> in a separate process, so that the peak memory is the one of the operation
+    '''
+    log.basicConfig(level=log.WARNING)
+    argv = ['-n', NAME_FILE, '--cache-dir', os.path.join(workdir, 'cache'), '-o',
+            '-b', str(options.batch_size), '-j', str(options.jobs), '--radio-jobs', str(options.radio_jobs)]
+    net = hmnet.network(rpcaddress, NAME_FILE, options.batch_size, options.jobs, os.path.join(workdir, 'cache'))
+    start = time.time()
+    if operation == 'backup':
+        hmbackup.create_link_backup(net, hmbackup.define_commandline_arguments().parse_args(
+                argv + ['-c', '-f', os.path.join(workdir, 'backup.json')]))
+    elif operation == 'restore':
+        hmbackup.restore_link_backup(net, hmbackup.define_commandline_arguments().parse_args(
+                argv + ['-r', '-w', '-f', os.path.join(workdir, 'restore.json')]))
+    elif operation == 'linktable':
+        net.getLinkTable()
+    seconds = time.time() - start
+    queue.put( (seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) )
+
+def modify_backup(workdir, fraction, seed=0):
+    '''
+        Writes restore.json: backup.json with another paramset for <fraction> of the links
+    '''
+    backup = load_backup(os.path.join(workdir, 'backup.json'))
+    rng = random.Random(seed)
+    psetids = sorted(backup['Paramsets'])
+    with BackupWriter(os.path.join(workdir, 'restore.json')) as writer:
+        for link in backup['Linklist']:
+            if rng.random() < fraction:
+                link['psetid'] = rng.choice(psetids)
+            writer.write_link(link)
+        writer.write_paramsets(backup['Paramsets'])
+
+def measure(operation, rpcaddress, options, workdir):
+    proxy = xmlrpclib.ServerProxy(rpcaddress)
+    proxy.fake.reset_stats()
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_operation, args=(operation, rpcaddress, options, workdir, queue))
+    process.start()
+    seconds, maxrss = queue.get()
+    process.join()
+    stats = proxy.fake.stats()
+    return {'operation':operation, 'seconds':seconds, 'roundtrips':stats['roundtrips'],
+            'calls':sum(stats['calls'].values()), 'peak_kb':maxrss}
+
+def benchmark(options):
+    results = list()
+    for links in options.sizes:
+        queue = multiprocessing.Queue()
+        server = multiprocessing.Process(target=serve, args=(options, links, queue))
+        server.daemon = True
+        server.start()
+        rpcaddress = 'http://127.0.0.1:%d'%queue.get()
+        workdir = tempfile.mkdtemp(prefix='hmbackup_benchmark')
+        try:
+            for operation in options.operations:
+                if operation == 'restore':
+                    modify_backup(workdir, options.modify)
+                result = measure(operation, rpcaddress, options, workdir)
+                result['links'] = links
+                results.append(result)
+                print '%8d %-10s %9.2fs %8d roundtrips %8d calls %10d KB peak'%(
+                        links, operation, result['seconds'], result['roundtrips'], result['calls'], result['peak_kb'])
+        finally:
+            server.terminate()
+            shutil.rmtree(workdir)
+    return results
+
+def define_commandline_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sizes', type=lambda s: [int(v) for v in s.split(',')], default=[100, 1000, 10000], help="Comma separated numbers of links")
+    parser.add_argument('--operations', type=lambda s: s.split(','), default=['backup', 'linktable', 'restore'], help="Comma separated operations (backup,linktable,restore)")
+    parser.add_argument('--links-per-receiver', type=int, default=4, help="Number of links per receiver channel")
+    parser.add_argument('--paramsets', type=int, default=20, help="Number of distinct link paramsets")
+    parser.add_argument('--modify', type=float, default=0.1, help="Fraction of links with changed paramset for restore")
+    parser.add_argument('--latency', type=float, default=0.0, help="Delay per http request in seconds")
+    parser.add_argument('--call-latency', type=float, default=0.0, help="Delay per called method in seconds")
+    parser.add_argument('-b', '--batch-size', type=int, default=50, help="Number of calls per system.multicall request")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of concurrent connections to rpc server")
+    parser.add_argument('--radio-jobs', type=int, default=1, help="Maximum number of concurrent radio operations during restore")
+    parser.add_argument('--json', help="Write results to this JSON file")
+    return parser
+
+if __name__ == '__main__':
+    options = define_commandline_arguments().parse_args()
+    if 'restore' in options.operations and 'backup' not in options.operations:
+        options.operations.insert(0, 'backup')
+    results = benchmark(options)
+    if options.json:
+        with open(options.json, 'w') as fd:
+            json.dump(results, fd, indent=1)
@@ -1,44 +1,278 @@
 # -*- coding: utf-8 -*-
 import json
 import logging as log
-import copy
+import os
+import tempfile
+import threading
 import xmlrpclib
+from collections import OrderedDict
+from paramsets import intern_paramset
 
-def DeviceFactory(description, rpcproxy, names_file):
+VALUE_TYPES = ['ENUM', 'FLOAT', 'INTEGER', 'BOOL', 'STRING']
+
+#Flags of RX_MODE in device descriptions
+RX_ALWAYS = 0x01
+RX_BURST = 0x02
+RX_CONFIG = 0x04
+RX_WAKEUP = 0x08
+RX_LAZY_CONFIG = 0x10
+
+def check_pset_value(name, new_value, info):
+    '''
+        Checks if <new_value> may be written to parameter <name> with the paramset description <info>.
+        Returns None if it may be written, otherwise the reason why not.
+        Values of unknown datatypes are not checked.
+    '''
+    if (info['OPERATIONS'] & 0x02) == 0:
+        return "Parameter %s is not writable"%name
+    if info['FLAGS'] & 0x04:
+        return "Transformflag of parameter %s is set. Aborting write of new value!"%name
+    if info['TYPE'] == 'ENUM':
+        if type(new_value) not in (int, long) or not 0 <= new_value < len(info['VALUE_LIST']):
+            return 'New value %s of parameter %s is out of allowed range'%(new_value, name)
+    elif info['TYPE'] in ['FLOAT', 'INTEGER', 'BOOL']:
+        minvalue = info['MIN']
+        maxvalue = info['MAX']
+        if new_value < minvalue or new_value > maxvalue:
+            if new_value == 16383000.0 and info['TYPE'] == 'FLOAT':
+                log.debug('Value out of range but identical to special value 16383000.0')
+            else:
+                return 'New value %s of parameter %s is out of range %s ... %s'%(new_value, name, minvalue, maxvalue)
+    return None
+
+class NameRegistry(object):
+    '''
+        User readable names of devices and channels read from a namefile (JSON) in the format
+        of Homematic-Manager. The file is parsed once per process and reread only if its
+        modification time changes. Use NameRegistry.get(filename) to get the shared instance.
+    '''
+    REGISTRIES = dict()
+    LOCK = threading.Lock()
+    @classmethod
+    def get(cls, names_file):
+        if isinstance(names_file, NameRegistry):
+            return names_file
+        with cls.LOCK:
+            key = os.path.abspath(names_file)
+            if key not in cls.REGISTRIES:
+                cls.REGISTRIES[key] = cls(names_file)
+            return cls.REGISTRIES[key]
+    def __init__(self, names_file):
+        self.names_file = names_file
+        self.mtime = None
+        self.names = dict()
+        self.lock = threading.Lock()
+    def reload_if_changed(self):
+        mtime = os.path.getmtime(self.names_file)
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            log.debug('Reading namefile "%s"', self.names_file)
+            with open(self.names_file) as fd:
+                self.names = json.load(fd)
+            self.mtime = mtime
+    def name(self, addr):
+        '''
+            Returns the name of <addr>. Channels without own name get the name of their device.
+            Returns None if neither is known.
+        '''
+        self.reload_if_changed()
+        if addr in self.names:
+            return self.names[addr]
+        return self.names.get(addr.split(':')[0])
+
+class ParamsetDescriptionCache(object):
+    '''
+        Paramset descriptions by device type, firmware and paramset name.
+        Every entry remembers the VERSION of the device description it was read for.
+        An entry is not used anymore if the VERSION of the device changes.
+        If a filename is given with load() the cache is persisted in this file.
+    '''
+    def __init__(self):
+        self.filename = None
+        self.entries = dict()
+        self.lock = threading.Lock()
+        self.dirty = False
+    @staticmethod
+    def key(desc, paramset_name):
+        firmware = desc.get('FIRMWARE') or desc.get('PARENT_FIRMWARE') or ''
+        return '|'.join([desc.get('PARENT_TYPE') or '', desc['TYPE'], firmware, paramset_name])
+    def load(self, filename):
+        '''
+            Preloads the cache from <filename> and persists it there from now on
+        '''
+        self.filename = filename
+        if not os.path.exists(filename):
+            return
+        try:
+            with open(filename) as fd:
+                entries = json.load(fd)
+        except ValueError, e:
+            log.warn('Ignoring damaged paramset description cache "%s": %s', filename, e)
+            return
+        with self.lock:
+            entries.update(self.entries)
+            self.entries = entries
+        log.debug('Loaded %d paramset descriptions from "%s"', len(entries), filename)
+    def save(self):
+        if self.filename is None or not self.dirty:
+            return
+        with self.lock:
+            path = os.path.dirname(os.path.abspath(self.filename))
+            if not os.path.exists(path):
+                os.makedirs(path)
+            fd, tmpname = tempfile.mkstemp(prefix='.paramset_descriptions.', suffix='.tmp', dir=path)
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump(self.entries, tmp)
+            os.rename(tmpname, self.filename)
+            self.dirty = False
+    def get(self, desc, paramset_name):
+        entry = self.entries.get(self.key(desc, paramset_name))
+        if entry is None or entry['VERSION'] != desc.get('VERSION'):
+            return None
+        return entry['DESCRIPTION']
+    def store(self, desc, paramset_name, info):
+        with self.lock:
+            self.entries[self.key(desc, paramset_name)] = {'VERSION':desc.get('VERSION'), 'DESCRIPTION':info}
+            self.dirty = True
+
+def DeviceFactory(description, rpcproxy, names, registry=None):
     if type(description) != dict:
         #description is assumed to be an address
+        if registry is not None:
+            return registry.get(description)
         description = rpcproxy.getDeviceDescription(description)
     classdict = {'HMW-LC-Sw2-DR':Sw2DR,
                  'SWITCH':Switch,
                  'KEY':Key}
     dtype = description['TYPE']
+    names = NameRegistry.get(names)
 
     if dtype in classdict:
-        return classdict[dtype](description, rpcproxy, names_file)
+        return classdict[dtype](description, rpcproxy, names, registry)
     else:
-        return HMDevice(description, rpcproxy, names_file)
+        return HMDevice(description, rpcproxy, names, registry)
+
+def annotate_parent_firmware(descriptions):
+    '''
+        Channels inherit the firmware of their device (PARENT_FIRMWARE) if it is part of <descriptions>
+    '''
+    firmware = dict( (desc['ADDRESS'], desc['FIRMWARE']) for desc in descriptions if 'FIRMWARE' in desc )
+    for desc in descriptions:
+        if desc.get('PARENT') in firmware:
+            desc['PARENT_FIRMWARE'] = firmware[desc['PARENT']]
+
+class DeviceRegistry(object):
+    '''
+        Holds exactly one HMDevice per address for the lifetime of a network session.
+        All devices are read with a single listDevices call on first use. Addresses which
+        are not known yet are read on demand with getDeviceDescription. refresh() rereads
+        all devices and keeps the identity of the device objects whose type did not change.
+    '''
+    def __init__(self, proxy, names):
+        self.proxy = proxy
+        self.names = names
+        self.devices = OrderedDict()
+        self.loaded = False
+        self.lock = threading.RLock()
+    def refresh(self):
+        self.load(self.proxy.listDevices())
+    def load(self, result):
+        '''
+            Replaces the known devices by the list of device descriptions <result> (e.g. of listDevices)
+        '''
+        annotate_parent_firmware(result)
+        with self.lock:
+            devices = OrderedDict()
+            for desc in result:
+                dev = self.devices.get(desc['ADDRESS'])
+                if dev is not None and dev.desc['TYPE'] == desc['TYPE']:
+                    dev.desc = desc
+                    dev.username = self.names.name(dev.addr)
+                else:
+                    dev = DeviceFactory(desc, self.proxy, self.names, self)
+                devices[dev.addr] = dev
+            self.devices = devices
+            self.loaded = True
+        log.debug('Read %d devices from network', len(self.devices))
+    def all(self):
+        with self.lock:
+            if not self.loaded:
+                self.refresh()
+            return self.devices.values()
+    def get(self, addr):
+        with self.lock:
+            if addr not in self.devices:
+                log.debug('Read description of device %s from network', addr)
+                self.devices[addr] = DeviceFactory(self.proxy.getDeviceDescription(addr), self.proxy, self.names, self)
+            return self.devices[addr]
+    def add(self, descriptions):
+        '''
+            Adds the devices of the list of device <descriptions> which are not known yet.
+            Used to work with a part of the network without reading all devices.
+        '''
+        annotate_parent_firmware(descriptions)
+        with self.lock:
+            for desc in descriptions:
+                if desc['ADDRESS'] not in self.devices:
+                    self.devices[desc['ADDRESS']] = DeviceFactory(desc, self.proxy, self.names, self)
+    def __contains__(self, addr):
+        return addr in self.devices
+
+class WriteStats(object):
+    '''
+        Counts the parameters and bytes of partial putParamset writes compared to writing
+        the full paramsets
+    '''
+    def __init__(self):
+        self.writes = 0
+        self.params_total = 0
+        self.params_sent = 0
+        self.bytes_total = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+    def record(self, full_pset, sent_pset):
+        bytes_total = len(xmlrpclib.dumps((dict(full_pset),), 'putParamset'))
+        bytes_sent = len(xmlrpclib.dumps((sent_pset,), 'putParamset'))
+        with self.lock:
+            self.writes += 1
+            self.params_total += len(full_pset)
+            self.params_sent += len(sent_pset)
+            self.bytes_total += bytes_total
+            self.bytes_sent += bytes_sent
+    def summary(self):
+        return '%d writes: sent %d of %d parameters (%d saved), %d of %d bytes (%d saved)'%(
+                self.writes, self.params_sent, self.params_total, self.params_total - self.params_sent,
+                self.bytes_sent, self.bytes_total, self.bytes_total - self.bytes_sent)
 
 class HMLink(object):
+    '''
+        Link between the channels <sender> and <receiver>. The receiver paramset is kept as
+        shared immutable FrozenParamset, so links with equal paramsets use the same object.
+    '''
+    __slots__ = ('sender', 'receiver', '_receiver_paramset', 'flags')
     def __init__(self, sender, receiver, receiver_paramset, flags):
         self.sender = sender
         self.receiver = receiver
         self.receiver_paramset = receiver_paramset
         self.flags = flags
-        self.proxy = sender.proxy
         if not self.receiver_paramset:
             log.debug("%s without paramset link"%self)
+    @property
+    def proxy(self):
+        return self.sender.proxy
+    @property
+    def receiver_paramset(self):
+        return self._receiver_paramset
+    @receiver_paramset.setter
+    def receiver_paramset(self, pset):
+        self._receiver_paramset = intern_paramset(pset)
     def callproxy(self, fkt, *args):
-        margs = list()
-        for arg in args:
-            if type(arg) == dict:
-                margs.append(str(arg))
-            else:
-                margs.append('"' + str(arg) + '"')
-        callstr = '%s(%s)'%(fkt, ', '.join(margs))
-        log.debug('Calling %s'%callstr)
+        log.debug('Calling %s%r', fkt, args)
         try:
-#            retval = eval('self.proxy.%s'%callstr)
-            retval = self.proxy.__getattr__(fkt)(*args)
+            retval = getattr(self.proxy, fkt)(*args)
             return retval
         except xmlrpclib.Fault,e:
             import traceback
@@ -51,20 +285,29 @@ class HMLink(object):
     def link_broken_receiver(self):
         return bool(self.flags & 0x02)
     def getParamset(self, reread_from_network=False):
+        '''
+            Returns the receiver paramset of the link (read from the network if it is not known or
+            <reread_from_network> is set). The paramset is an immutable FrozenParamset shared with other
+            links. Use dict(link.getParamset()) to get a copy which can be changed.
+        '''
         if reread_from_network or not self.receiver_paramset:
-            log.debug('Reading receiver paramset from network (%s)'%self.receiver)
-            log.debug('%s, %s'%(reread_from_network, str(self.receiver_paramset)[:10]))
+            log.debug('Reading receiver paramset from network (%s)', self.receiver)
+            log.debug('%s, %.10s', reread_from_network, self.receiver_paramset)
             self.receiver_paramset = self.callproxy('getParamset', self.receiver.addr, self.sender.addr)
         else:
-            log.debug('Supply receiver paramset from cache (%s)'%self.receiver)
+            log.debug('Supply receiver paramset from cache (%s)', self.receiver)
         return self.receiver_paramset
     def getParamsetDescription(self):
         info = self.receiver.get_paramset_info('LINK')
         return info
         
-    def setParamset(self, paramset, drymode=True):
+    def setParamset(self, paramset, drymode=True, stats=None):
+        '''
+            Writes the values of <paramset> which differ from the paramset of the link.
+            Only the changed keys are sent with putParamset. Returns the dict of changed keys.
+            stats: Optional WriteStats which counts the parameters and bytes saved by the partial write
+        '''
         existing_pset = self.getParamset()
-        new_pset = copy.deepcopy(existing_pset)
         not_com_keys = set(paramset.keys()).symmetric_difference(existing_pset.keys())
         if len(not_com_keys) > 0:
             msg = 'Link %s\n    Keys %s are not common present in device or paramset to put'%(self, not_com_keys)
@@ -72,7 +315,7 @@ class HMLink(object):
             raise EnvironmentError(msg)
 
         firsttime=True
-        psetchanged=False
+        new_pset = dict()
         pset_info = self.getParamsetDescription()
         for key in sorted(paramset.keys()):
             v1 = paramset[key]
@@ -91,51 +334,36 @@ class HMLink(object):
             ok = self.check_new_pset_value(key, v2, v1, pset_info[key])
             if ok:
                 new_pset[key] = paramset[key]
-                psetchanged = True
-        if not drymode and psetchanged:
-            self.callproxy('putParamset', self.receiver.addr, self.sender.addr, paramset)
+        if new_pset and stats is not None:
+            stats.record(paramset, new_pset)
+        if not drymode and new_pset:
+            self.callproxy('putParamset', self.receiver.addr, self.sender.addr, new_pset)
+            updated = dict(existing_pset)
+            updated.update(new_pset)
+            self.receiver_paramset = updated
+        return new_pset
     def check_new_pset_value(self, name, old_value, new_value, info):
         log.debug(' Setting key %s', name)
-        if (info['OPERATIONS'] & 0x02) == 0:
-            msg = "Parameter %s is not writable"%name
-            log.error(msg)
-            raise EnvironmentError(msg)
-        if info['FLAGS'] & 0x04:
-            msg = "Transformflag of parameter %s is set. Aborting write of new value!"%name
+        msg = check_pset_value(name, new_value, info)
+        if msg:
             log.error(msg)
             raise EnvironmentError(msg)
+        if info['TYPE'] not in VALUE_TYPES:
+            log.debug('Unknown datatype %s. Ignoring parameter %s', info['TYPE'], name)
+            return False
         if info['TYPE'] == 'ENUM':
-            log.debug('   Datatype is enum with values %s'%info['VALUE_LIST'])
             old_value = info['VALUE_LIST'][old_value]
-            try:
-                new_value = info['VALUE_LIST'][new_value]
-            except IndexError:
-                msg = 'New value %d of parameter %s is out of allowed range'%(new_value, name)
-                log.error(msg)
-                raise EnvironmentError(msg)
-        elif info['TYPE'] in ['FLOAT', 'INTEGER', 'BOOL']:
-            minvalue = info['MIN']
-            maxvalue = info['MAX']
-            log.debug('%s <= new value <= %s'%(minvalue, maxvalue))
-            log.debug('New value is %s'%new_value)
-            if new_value < minvalue or new_value > maxvalue:
-                if new_value == 16383000.0 and info['TYPE'] == 'FLOAT':
-                    log.debug('Value out of range but identical to special value 16383000.0')
-                else:
-                    msg = 'New value %s is out of range %s ... %s'%(new_value, minvalue, maxvalue)
-                    log.error(msg)
-                    raise EnvironmentError(msg)
-        elif info['TYPE'] == 'STRING':
-            log.debug('Datatype is string')
-        else:
-            log.debug('Unknown datatype %s. Ignoring parameter %s'%(info['TYPE'], name) )
-            return False
+            new_value = info['VALUE_LIST'][new_value]
         log.debug('Changing [%s] from %s to %s', name, old_value, new_value)
         return True
     def __eq__(self, other):
         eq1 = self.sender.addr == other.sender.addr
         eq2 = self.receiver.addr == other.receiver.addr
         return eq1 and eq2
+    def __ne__(self, other):
+        return not self == other
+    def __hash__(self):
+        return hash( (self.sender.addr, self.receiver.addr) )
         
     def __repr__(self):
         br = ''
@@ -159,38 +387,60 @@ class HMLink(object):
         return unicode(self).encode('utf-8')
         
 class HMDevice(object):
-    PARAMSET_INFO = dict()
-    def __init__(self, description, proxy, names_file):
+    __slots__ = ('proxy', 'desc', 'addr', 'names', 'username', 'registry')
+    PARAMSET_INFO = ParamsetDescriptionCache()
+    def __init__(self, description, proxy, names, registry=None):
         self.proxy = proxy
         self.desc  = description
         self.addr  = self.desc['ADDRESS']
-        with open(names_file) as fd:
-            data = json.load(fd)
-        if self.addr in data:
-            self.username = data[self.addr]
-        else:
-            self.username = None
+        self.names = names
+        self.username = names.name(self.addr)
+        self.registry = registry
+    def has_paramset_info(self, paramset_name):
+        return self.PARAMSET_INFO.get(self.desc, paramset_name) is not None
+    def store_paramset_info(self, paramset_name, info):
+        self.PARAMSET_INFO.store(self.desc, paramset_name, info)
     def get_paramset_info(self, paramset_name, force_reread_from_network=False):
         mytype = self.desc['TYPE']
-        if mytype not in self.PARAMSET_INFO or force_reread_from_network:
-            log.debug('Get info of devicetype %s and parameterset %s from network'%(mytype, paramset_name))
-            self.PARAMSET_INFO[mytype] = self.proxy.getParamsetDescription(self.addr, paramset_name)
+        info = self.PARAMSET_INFO.get(self.desc, paramset_name)
+        if info is None or force_reread_from_network:
+            log.debug('Get info of devicetype %s and parameterset %s from network', mytype, paramset_name)
+            info = self.proxy.getParamsetDescription(self.addr, paramset_name)
+            self.store_paramset_info(paramset_name, info)
+            self.PARAMSET_INFO.save()
         else:
-            log.debug('Get info of devicetype %s and parameterset %s from cache'%(mytype, paramset_name))
-        return self.PARAMSET_INFO[mytype]
+            log.debug('Get info of devicetype %s and parameterset %s from cache', mytype, paramset_name)
+        return info
         
+    def rx_mode(self):
+        '''
+            RX_MODE of the device. Channels have the mode of their parent device.
+            Devices without RX_MODE (e.g. wired devices) are always receiving.
+        '''
+        if 'RX_MODE' in self.desc:
+            return self.desc['RX_MODE']
+        parent = self.desc.get('PARENT')
+        if parent and self.registry is not None:
+            return self.registry.get(parent).rx_mode()
+        return RX_ALWAYS
+    def is_sleeping(self):
+        '''
+            True for battery powered devices which do not receive all the time. Configuration changes reach
+            them with a wake-up burst, on their next wake-up or when their config button is pressed.
+        '''
+        return not self.rx_mode() & RX_ALWAYS
     def get_paramset(self, name):
         return self.proxy.getParamset(self.addr, name)
     def get_link_peers(self):
         result = self.proxy.getLinkPeers(self.addr)
-        return [DeviceFactory(self.proxy.getDeviceDescription(d), self.proxy) for d in result]
+        return [DeviceFactory(d, self.proxy, self.names, self.registry) for d in result]
     def get_links(self):
         result = self.proxy.getLinks(self.addr)
         links = list()
         for r in result:
-            sender = DeviceFactory(r['SENDER'], self.proxy)
-            receiver = DeviceFactory(r['RECEIVER'], self.proxy)
-            links.append( HMLink(sender, receiver) )
+            sender = DeviceFactory(r['SENDER'], self.proxy, self.names, self.registry)
+            receiver = DeviceFactory(r['RECEIVER'], self.proxy, self.names, self.registry)
+            links.append( HMLink(sender, receiver, None, r['FLAGS']) )
         return links
     def __unicode__(self):
         result = u'Homematic Device %s addr:%s name:"%s"'%(self.desc['TYPE'], self.addr, self.username)
@@ -200,12 +450,14 @@ class HMDevice(object):
     def __repr__(self):
         return '%s %s'%(type(self), self.addr)
 class Sw2DR(HMDevice):
-    def __init__(self, description, proxy, names_file):
-        HMDevice.__init__(self, description, proxy, names_file)
+    __slots__ = ()
+    def __init__(self, description, proxy, names, registry=None):
+        HMDevice.__init__(self, description, proxy, names, registry)
         
 class Switch(HMDevice):
-    def __init__(self, description, proxy, names_file):
-        HMDevice.__init__(self, description, proxy, names_file)
+    __slots__ = ()
+    def __init__(self, description, proxy, names, registry=None):
+        HMDevice.__init__(self, description, proxy, names, registry)
     def state(self):
         pset = self.proxy.getParamset(self.addr, 'VALUES')
         return pset['STATE']
@@ -215,8 +467,9 @@ class Switch(HMDevice):
         result = u'SWITCH: Addr: %s "%s"'%(self.addr, self.username)
         return result
 class Key(HMDevice):
-    def __init__(self, description, proxy, names_file):
-        HMDevice.__init__(self, description, proxy, names_file)
+    __slots__ = ()
+    def __init__(self, description, proxy, names, registry=None):
+        HMDevice.__init__(self, description, proxy, names, registry)
     def __unicode__(self):
         result = u"KEY: Addr: %s (%s)"%(self.addr, self.username)
         return result
@@ -226,13 +479,13 @@ if __name__=='__main__':
 
     proxy = xmlrpclib.ServerProxy("http://hpi:2001/")
     result = proxy.listDevices()
-    dev = [DeviceFactory(desc, proxy) for desc in result]
+    dev = [DeviceFactory(desc, proxy, 'homematic_manager_names.json') for desc in result]
     for d in dev:
         if d.addr == 'LEQ1181007:4':
             break
     l = d.get_links()[0]
 
-    pset = l.getParamset()
+    pset = dict(l.getParamset())
     print pset['LONG_ACTION_TYPE']
     pset['LONG_ACTION_TYPE'] = 1
     l.setParamset(pset)
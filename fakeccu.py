@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+import argparse
+import copy
+import random
+import threading
+import time
+import SocketServer
+import SimpleXMLRPCServer
+import xmlrpclib
+import logging as log
+
+#Simulated CCU xmlrpc server. Used for benchmarks and tests without a real CCU.
+
+RX_ALWAYS = 0x01
+RX_BURST = 0x02
+RX_CONFIG = 0x04
+RX_WAKEUP = 0x08
+RX_LAZY_CONFIG = 0x10
+
+def enum(values, default=0):
+    return {'TYPE':'ENUM', 'VALUE_LIST':values, 'MIN':0, 'MAX':len(values)-1, 'DEFAULT':default,
+            'OPERATIONS':3, 'FLAGS':1, 'UNIT':''}
+def number(dtype, minvalue, maxvalue, default):
+    return {'TYPE':dtype, 'MIN':minvalue, 'MAX':maxvalue, 'DEFAULT':default,
+            'OPERATIONS':3, 'FLAGS':1, 'UNIT':''}
+
+ACTION_TYPES = ['INACTIVE', 'JUMP_TO_TARGET', 'TOGGLE_TO_COUNTER', 'TOGGLE_INVERS_TO_COUNTER']
+STATES = ['NO_JUMP_IGNORE_COMMAND', 'ONDELAY', 'ON', 'OFFDELAY', 'OFF']
+
+SWITCH_LINK_DESCRIPTION = {
+    'SHORT_ACTION_TYPE': enum(ACTION_TYPES, 1),
+    'LONG_ACTION_TYPE': enum(ACTION_TYPES, 1),
+    'SHORT_JT_ON': enum(STATES, 3),
+    'SHORT_JT_OFF': enum(STATES, 1),
+    'LONG_JT_ON': enum(STATES, 3),
+    'LONG_JT_OFF': enum(STATES, 1),
+    'SHORT_ON_TIME': number('FLOAT', 0.0, 111600.0, 16383000.0),
+    'SHORT_OFF_TIME': number('FLOAT', 0.0, 111600.0, 16383000.0),
+    'LONG_ON_TIME': number('FLOAT', 0.0, 111600.0, 16383000.0),
+    'LONG_OFF_TIME': number('FLOAT', 0.0, 111600.0, 16383000.0),
+    'SHORT_ONDELAY_TIME': number('FLOAT', 0.0, 111600.0, 0.0),
+    'LONG_ONDELAY_TIME': number('FLOAT', 0.0, 111600.0, 0.0),
+    'LONG_MULTIEXECUTE': number('BOOL', False, True, True),
+    'UI_HINT': {'TYPE':'STRING', 'DEFAULT':'', 'OPERATIONS':3, 'FLAGS':1, 'UNIT':''},
+}
+MASTER_DESCRIPTION = {
+    'AES_ACTIVE': number('BOOL', False, True, False),
+}
+MAINTENANCE_VALUES_DESCRIPTION = {
+    'CONFIG_PENDING': dict(number('BOOL', False, True, False), OPERATIONS=5),
+    'UNREACH': dict(number('BOOL', False, True, False), OPERATIONS=5),
+}
+
+def default_paramset(description):
+    return dict( (k, v['DEFAULT']) for k, v in description.iteritems() )
+
+class FakeCCU(object):
+    '''
+        State and xmlrpc methods of a simulated CCU interface
+        links: Number of links
+        links_per_receiver: Number of links per receiving switch channel
+        paramsets: Number of distinct link paramsets
+        latency: Delay in seconds per http request (round trip)
+        call_latency: Delay in seconds per called method (also per method within system.multicall)
+        sleeping: Fraction of the receiving devices which are battery powered and not always receiving.
+                  The remotes are always battery powered.
+        wakeup: Seconds a configuration change of a sleeping device blocks the call (wake-up burst).
+                CONFIG_PENDING of the device stays set for the same time afterwards.
+    '''
+    def __init__(self, links=100, links_per_receiver=4, paramsets=20, latency=0.0, call_latency=0.0, seed=0,
+                 sleeping=0.0, wakeup=1.0):
+        self.latency = latency
+        self.call_latency = call_latency
+        self.wakeup = wakeup
+        self.sleeping_devices = set()
+        self.lock = threading.RLock()
+        self.callbacks = dict()
+        self.devices = dict()
+        self.device_order = list()
+        self.paramsets = dict()
+        self.links = dict()
+        self.reset_stats()
+
+        rng = random.Random(seed)
+        templates = list()
+        for i in range(max(1, paramsets)):
+            pset = default_paramset(SWITCH_LINK_DESCRIPTION)
+            pset['SHORT_ACTION_TYPE'] = i % 2
+            pset['SHORT_ON_TIME'] = [16383000.0, 60.0, 120.0, 300.0, 0.5][i % 5]
+            pset['LONG_JT_OFF'] = i % len(STATES)
+            pset['SHORT_ONDELAY_TIME'] = float(i // 10)
+            templates.append(pset)
+
+        nreceivers = max(1, (links + links_per_receiver - 1) // links_per_receiver)
+        senders = list()
+        receivers = list()
+        for i in range(nreceivers):
+            addr = 'FAK%07d'%i
+            if int((i + 1)*sleeping) > int(i*sleeping):
+                self.add_device(addr, 'HM-LC-Sw1-Ba-PCB', RX_BURST|RX_CONFIG, [('KEY', 'SENDER'), ('SWITCH', 'RECEIVER')])
+            else:
+                self.add_device(addr, 'HM-LC-Sw1PBU-FM', RX_ALWAYS|RX_CONFIG, [('KEY', 'SENDER'), ('SWITCH', 'RECEIVER')])
+            senders.append(addr + ':1')
+            receivers.append(addr + ':2')
+        for i in range(max(1, nreceivers // 4)):
+            addr = 'RMT%07d'%i
+            self.add_device(addr, 'HM-RC-4', RX_CONFIG|RX_WAKEUP, [('KEY', 'SENDER')]*4)
+            senders.extend( ['%s:%d'%(addr, c) for c in range(1, 5)] )
+
+        while len(self.links) < links:
+            sender = rng.choice(senders)
+            receiver = receivers[len(self.links) // links_per_receiver]
+            if (sender, receiver) in self.links:
+                continue
+            self.links[(sender, receiver)] = dict(rng.choice(templates))
+
+    def add_device(self, addr, dtype, rx_mode, channels):
+        children = ['%s:%d'%(addr, c) for c in range(len(channels) + 1)]
+        if not rx_mode & RX_ALWAYS:
+            self.sleeping_devices.add(addr)
+        self.devices[addr] = {'ADDRESS':addr, 'TYPE':dtype, 'PARENT':'', 'PARENT_TYPE':'',
+                              'FIRMWARE':'1.4', 'VERSION':1, 'RX_MODE':rx_mode, 'CHILDREN':children,
+                              'PARAMSETS':['MASTER'], 'FLAGS':1, 'INTERFACE':'FAK0000000'}
+        self.paramsets[(addr, 'MASTER')] = default_paramset(MASTER_DESCRIPTION)
+        self.device_order.append(addr)
+        channels = [('MAINTENANCE', '')] + list(channels)
+        for idx, (ctype, direction) in enumerate(channels):
+            caddr = children[idx]
+            self.devices[caddr] = {'ADDRESS':caddr, 'TYPE':ctype, 'PARENT':addr, 'PARENT_TYPE':dtype,
+                                   'VERSION':1, 'AES_ACTIVE':0, 'CHILDREN':[], 'FLAGS':1, 'INDEX':idx,
+                                   'LINK_SOURCE_ROLES':'SWITCH' if direction == 'SENDER' else '',
+                                   'LINK_TARGET_ROLES':'SWITCH' if direction == 'RECEIVER' else '',
+                                   'DIRECTION':{'':0, 'SENDER':1, 'RECEIVER':2}[direction],
+                                   'PARAMSETS':['MASTER', 'VALUES'] + (['LINK'] if direction else [])}
+            self.paramsets[(caddr, 'MASTER')] = default_paramset(MASTER_DESCRIPTION)
+            if ctype == 'MAINTENANCE':
+                self.paramsets[(caddr, 'VALUES')] = default_paramset(MAINTENANCE_VALUES_DESCRIPTION)
+            self.device_order.append(caddr)
+
+    def reset_stats(self):
+        with self.lock:
+            self.roundtrips = 0
+            self.calls = dict()
+    def roundtrip(self):
+        with self.lock:
+            self.roundtrips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _dispatch(self, method, params):
+        func = getattr(self, 'rpc_' + method.replace('.', '_'), None)
+        if func is None:
+            raise xmlrpclib.Fault(-1, 'Unknown method "%s"'%method)
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if self.call_latency:
+            time.sleep(self.call_latency)
+        return func(*params)
+
+    def notify(self, method, *args):
+        '''
+            Calls <method> of all callback servers registered with init() in a background thread
+        '''
+        with self.lock:
+            callbacks = self.callbacks.items()
+        if not callbacks:
+            return
+        def send():
+            for interface_id, url in callbacks:
+                try:
+                    getattr(xmlrpclib.ServerProxy(url, allow_none=True), method)(interface_id, *args)
+                except Exception, e:
+                    log.warn('Callback %s of %s failed: %s', method, url, e)
+        thread = threading.Thread(target=send)
+        thread.daemon = True
+        thread.start()
+
+    def configure(self, *addresses):
+        '''
+            Simulates the transfer of a configuration change to the devices of <addresses>
+        '''
+        for serial in sorted(set(a.split(':')[0] for a in addresses) & self.sleeping_devices):
+            time.sleep(self.wakeup)
+            self.set_config_pending(serial, True)
+            timer = threading.Timer(self.wakeup, self.set_config_pending, (serial, False))
+            timer.daemon = True
+            timer.start()
+    def set_config_pending(self, serial, value):
+        with self.lock:
+            self.paramsets[(serial + ':0', 'VALUES')]['CONFIG_PENDING'] = value
+        self.notify('event', serial + ':0', 'CONFIG_PENDING', value)
+
+    def check_device(self, addr):
+        if addr not in self.devices:
+            raise xmlrpclib.Fault(-2, 'Unknown instance')
+        return self.devices[addr]
+    def link_description(self, addr):
+        if self.check_device(addr)['TYPE'] != 'SWITCH':
+            raise xmlrpclib.Fault(-3, 'Unknown paramset')
+        return SWITCH_LINK_DESCRIPTION
+
+    def rpc_listDevices(self, interface_id=None):
+        with self.lock:
+            return [self.devices[addr] for addr in self.device_order]
+    def rpc_getDeviceDescription(self, addr):
+        with self.lock:
+            return self.check_device(addr)
+    def rpc_getLinks(self, addr='', flags=0):
+        with self.lock:
+            result = list()
+            for (sender, receiver) in sorted(self.links):
+                if addr and addr not in (sender, receiver, sender.split(':')[0], receiver.split(':')[0]):
+                    continue
+                data = {'SENDER':sender, 'RECEIVER':receiver, 'FLAGS':0, 'NAME':'', 'DESCRIPTION':''}
+                if flags & 0x04:
+                    data['RECEIVER_PARAMSET'] = self.links[(sender, receiver)]
+                result.append(data)
+            return result
+    def rpc_getLinkPeers(self, addr):
+        with self.lock:
+            self.check_device(addr)
+            peers = [r for (s, r) in self.links if s == addr] + [s for (s, r) in self.links if r == addr]
+            return sorted(peers)
+    def rpc_getParamset(self, addr, key):
+        with self.lock:
+            self.check_device(addr)
+            if (key, addr) in self.links:
+                return self.links[(key, addr)]
+            if (addr, key) in self.paramsets:
+                return self.paramsets[(addr, key)]
+            raise xmlrpclib.Fault(-3, 'Unknown paramset')
+    def rpc_putParamset(self, addr, key, pset):
+        with self.lock:
+            self.check_device(addr)
+            if (key, addr) in self.links:
+                description = self.link_description(addr)
+                target = self.links[(key, addr)]
+            elif (addr, key) in self.paramsets:
+                description = MASTER_DESCRIPTION
+                target = self.paramsets[(addr, key)]
+            else:
+                raise xmlrpclib.Fault(-3, 'Unknown paramset')
+            for k in pset:
+                if k not in description:
+                    raise xmlrpclib.Fault(-5, 'Unknown parameter %s'%k)
+            target.update(pset)
+        self.configure(addr)
+        if (key, addr) in self.links:
+            self.notify('updateDevice', addr, 0)
+        return ''
+    def rpc_getValue(self, addr, key):
+        with self.lock:
+            self.check_device(addr)
+            values = self.paramsets.get((addr, 'VALUES'), dict())
+            if key not in values:
+                raise xmlrpclib.Fault(-5, 'Unknown parameter %s'%key)
+            return values[key]
+    def rpc_getParamsetDescription(self, addr, key):
+        with self.lock:
+            self.check_device(addr)
+            if key == 'LINK':
+                return self.link_description(addr)
+            if key == 'MASTER':
+                return MASTER_DESCRIPTION
+            if key == 'VALUES' and self.devices[addr]['TYPE'] == 'MAINTENANCE':
+                return MAINTENANCE_VALUES_DESCRIPTION
+            raise xmlrpclib.Fault(-3, 'Unknown paramset')
+    def rpc_addLink(self, sender, receiver, name='', description=''):
+        with self.lock:
+            self.check_device(sender)
+            self.link_description(receiver)
+            if (sender, receiver) not in self.links:
+                self.links[(sender, receiver)] = default_paramset(SWITCH_LINK_DESCRIPTION)
+        self.configure(sender, receiver)
+        self.notify('updateDevice', sender, 1)
+        self.notify('updateDevice', receiver, 1)
+        return ''
+    def rpc_removeLink(self, sender, receiver):
+        with self.lock:
+            if (sender, receiver) not in self.links:
+                raise xmlrpclib.Fault(-2, 'Unknown link')
+            del self.links[(sender, receiver)]
+        self.configure(sender, receiver)
+        self.notify('updateDevice', sender, 1)
+        self.notify('updateDevice', receiver, 1)
+        return ''
+    def rpc_init(self, url, interface_id=''):
+        '''
+            Registers the callback server <url> under <interface_id>. An empty interface_id unregisters it.
+        '''
+        with self.lock:
+            for iface in [i for i, u in self.callbacks.items() if u == url]:
+                del self.callbacks[iface]
+            if interface_id:
+                self.callbacks[interface_id] = url
+        return ''
+    def rpc_ping(self, caller_id):
+        self.notify('event', 'CENTRAL', 'PONG', caller_id)
+        return True
+    def rpc_fake_stats(self):
+        with self.lock:
+            return {'roundtrips':self.roundtrips, 'calls':copy.deepcopy(self.calls), 'links':len(self.links)}
+    def rpc_fake_reset_stats(self):
+        self.reset_stats()
+        return ''
+
+class FakeCCURequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    rpc_paths = ()
+    def do_POST(self):
+        self.server.ccu.roundtrip()
+        SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.do_POST(self)
+
+class FakeCCUServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer.SimpleXMLRPCServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, ccu, host='127.0.0.1', port=2000):
+        SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(self, (host, port), FakeCCURequestHandler,
+                                                       logRequests=False, allow_none=True)
+        self.ccu = ccu
+        self.register_instance(ccu)
+        self.register_multicall_functions()
+        self.register_introspection_functions()
+
+def start_server(ccu, host='127.0.0.1', port=0):
+    '''
+        Serves <ccu> in a background thread. Port 0 selects a free port.
+        Returns the server. Its address is server.server_address.
+    '''
+    server = FakeCCUServer(ccu, host, port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def define_commandline_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-s', '--host', default='127.0.0.1', help="Address to listen on")
+    parser.add_argument('-p', '--port', type=int, default=2000, help="Port to listen on")
+    parser.add_argument('-l', '--links', type=int, default=100, help="Number of links")
+    parser.add_argument('--links-per-receiver', type=int, default=4, help="Number of links per receiver channel")
+    parser.add_argument('--paramsets', type=int, default=20, help="Number of distinct link paramsets")
+    parser.add_argument('--latency', type=float, default=0.0, help="Delay per http request in seconds")
+    parser.add_argument('--call-latency', type=float, default=0.0, help="Delay per called method in seconds")
+    parser.add_argument('--sleeping', type=float, default=0.0, help="Fraction of receiving devices which are battery powered (not always receiving)")
+    parser.add_argument('--wakeup', type=float, default=1.0, help="Seconds a configuration change of a sleeping device blocks and stays pending")
+    return parser
+
+if __name__ == '__main__':
+    options = define_commandline_arguments().parse_args()
+    log.basicConfig(format='[%(levelname)s] %(filename)s(%(lineno)s): %(message)s', level=log.INFO)
+    ccu = FakeCCU(options.links, options.links_per_receiver, options.paramsets, options.latency, options.call_latency,
+                  sleeping=options.sleeping, wakeup=options.wakeup)
+    server = FakeCCUServer(ccu, options.host, options.port)
+    log.info('Fake CCU with %d devices and %d links listening on %s:%d', len(ccu.devices), len(ccu.links), options.host, options.port)
+    server.serve_forever()
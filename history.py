@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import tempfile
+import time
+import zlib
+from collections import OrderedDict
+from backupfile import BackupWriter, encode, link_sortkey
+from backupdiff import diff_links
+
+import logging as log
+
+#Content addressed store of backup snapshots. Unchanged paramsets and link chunks are stored only once.
+
+def chunk_key(link):
+    '''
+        Links are stored in chunks of one receiver device. A changed link only creates a new chunk of its receiver.
+    '''
+    key = link['receiver'].split(':')[0]
+    if 'iface' in link:
+        key = '%s|%s'%(link['iface'], key)
+    return key
+
+def dumps(data):
+    return encode(json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+
+class HistoryStore(object):
+    '''
+        Directory with the backup history:
+        objects/<2 hex>/<38 hex>: Objects (paramsets and link chunks) named by the SHA1 of their content.
+                                  Compressed objects start with "z" followed by the zlib data.
+        snapshots/<id>.json: Manifest of one backup with the object ids of its link chunks (by receiver
+                             device) and paramsets (by psetid). The id is derived from the manifest content.
+        checkout/<id>.json: Backup files of snapshots written for a restore
+    '''
+    def __init__(self, path, compress=False, create=False):
+        self.path = path
+        self.compress = compress
+        if not create and not os.path.exists(os.path.join(path, 'snapshots')):
+            raise EnvironmentError('History "%s" does not exist'%path)
+        for subdir in ['objects', 'snapshots']:
+            if not os.path.exists(os.path.join(path, subdir)):
+                os.makedirs(os.path.join(path, subdir))
+    def object_filename(self, objid):
+        return os.path.join(self.path, 'objects', objid[:2], objid[2:])
+    def write_atomic(self, filename, data):
+        path = os.path.dirname(filename)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        fd, tmpname = tempfile.mkstemp(prefix='.tmp.', dir=path)
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(data)
+        os.rename(tmpname, filename)
+    def put(self, data):
+        '''
+            Stores the JSON serializable <data> if it is not present yet and returns its object id
+        '''
+        raw = dumps(data)
+        objid = hashlib.sha1(raw).hexdigest()
+        filename = self.object_filename(objid)
+        if not os.path.exists(filename):
+            self.write_atomic(filename, 'z' + zlib.compress(raw) if self.compress else raw)
+        return objid
+    def get(self, objid):
+        with open(self.object_filename(objid), 'rb') as fd:
+            raw = fd.read()
+        if raw.startswith('z'):
+            raw = zlib.decompress(raw[1:])
+        return json.loads(raw, object_pairs_hook=OrderedDict)
+
+    def add(self, links, paramsets, devices, source=None):
+        '''
+            Stores a backup and returns the id of its snapshot
+            links: list of link dicts of the backup file
+            paramsets: dict of paramsets by psetid
+            devices: dict of device metadata by address
+        '''
+        chunks = OrderedDict()
+        for link in links:
+            chunks.setdefault(chunk_key(link), list()).append(link)
+        manifest = OrderedDict()
+        manifest['timestamp'] = time.time()
+        manifest['created'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(manifest['timestamp']))
+        manifest['source'] = source
+        manifest['links'] = len(links)
+        manifest['chunks'] = OrderedDict()
+        for key in sorted(chunks):
+            addresses = sorted(set(l['receiver'] for l in chunks[key]))
+            chunk = OrderedDict([('links', chunks[key]),
+                                 ('devices', OrderedDict( (a, devices[a]) for a in addresses if a in devices ))])
+            manifest['chunks'][key] = self.put(chunk)
+        manifest['paramsets'] = OrderedDict( (psetid, self.put(paramsets[psetid])) for psetid in sorted(paramsets) )
+        raw = dumps(manifest)
+        snapid = hashlib.sha1(raw).hexdigest()[:12]
+        self.write_atomic(os.path.join(self.path, 'snapshots', snapid + '.json'), raw)
+        log.info('Stored snapshot %s with %d links in %d chunks and %d paramsets', snapid, len(links),
+                 len(manifest['chunks']), len(manifest['paramsets']))
+        return snapid
+
+    def manifest(self, snapid):
+        '''
+            Returns the manifest of the snapshot <snapid> (unique prefix of an id is sufficient)
+        '''
+        ids = [i for i in self.snapshot_ids() if i.startswith(snapid)]
+        if len(ids) != 1:
+            raise EnvironmentError('%s snapshot with id "%s" in history "%s"'%('No' if not ids else 'More than one', snapid, self.path))
+        with open(os.path.join(self.path, 'snapshots', ids[0] + '.json')) as fd:
+            manifest = json.load(fd, object_pairs_hook=OrderedDict)
+        manifest['id'] = ids[0]
+        return manifest
+    def snapshot_ids(self):
+        return [f[:-5] for f in os.listdir(os.path.join(self.path, 'snapshots')) if f.endswith('.json')]
+    def snapshots(self):
+        '''
+            Returns the manifests of all snapshots sorted by creation time
+        '''
+        return sorted([self.manifest(i) for i in self.snapshot_ids()], key=lambda m: (m['timestamp'], m['id']))
+    def printout(self, fd):
+        for m in self.snapshots():
+            fd.write('%s  %s  %6d links  %5d paramsets  %s\n'%(m['id'], m['created'], m['links'], len(m['paramsets']), m['source'] or ''))
+
+    def checkout(self, snapid, filename=None):
+        '''
+            Writes the backup file of snapshot <snapid> (default: checkout/<id>.json in the history) and returns its name.
+            The file has the same content as the backup file the snapshot was created from.
+        '''
+        manifest = self.manifest(snapid)
+        if filename is None:
+            path = os.path.join(self.path, 'checkout')
+            if not os.path.exists(path):
+                os.makedirs(path)
+            filename = os.path.join(path, manifest['id'] + '.json')
+            if os.path.exists(filename):
+                return filename
+        links = list()
+        devices = dict()
+        for objid in manifest['chunks'].itervalues():
+            chunk = self.get(objid)
+            links.extend(chunk['links'])
+            devices.update(chunk['devices'])
+        paramsets = dict( (psetid, self.get(objid)) for psetid, objid in manifest['paramsets'].iteritems() )
+        with BackupWriter(filename) as writer:
+            for link in sorted(links, key=link_sortkey):
+                writer.write_link(link)
+            writer.write_paramsets(paramsets)
+            writer.write_devices(devices)
+        log.info('Wrote snapshot %s to "%s"', manifest['id'], filename)
+        return filename
+
+    def diff(self, old_id, new_id):
+        '''
+            Changes of the links from snapshot <old_id> to <new_id> (see backupdiff.diff_links).
+            Only the link chunks and paramsets whose object ids differ are read.
+        '''
+        old = self.manifest(old_id)
+        new = self.manifest(new_id)
+        old_links = dict()
+        new_links = dict()
+        for key in set(old['chunks']) | set(new['chunks']):
+            old_obj = old['chunks'].get(key)
+            new_obj = new['chunks'].get(key)
+            if old_obj != new_obj:
+                old_links.update(self.chunk_links(old_obj))
+                new_links.update(self.chunk_links(new_obj))
+        return diff_links(old_links, new_links, self.paramset_getter(old), self.paramset_getter(new))
+    def chunk_links(self, objid):
+        if objid is None:
+            return dict()
+        return dict( ((l['sender'], l['receiver']), l) for l in self.get(objid)['links'] if not l['delete'] )
+    def paramset_getter(self, manifest):
+        def paramset(psetid):
+            objid = manifest['paramsets'].get(psetid)
+            return self.get(objid) if objid else None
+        return paramset
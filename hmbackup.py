@@ -3,9 +3,18 @@
 import argparse
 import os
 import sys
+import time
+import backupdiff
+import backupindex
+import history
 import hmnet
-from devices import HMLink, DeviceFactory
-import json
+import journal
+import mirror
+import restore
+import rpcprofile
+import validate
+from paramsets import ParamsetTable
+from backupfile import BackupReader, BackupWriter, link_sortkey, load_backup
 from collections import OrderedDict
 import pandas as pd
 
@@ -13,25 +22,61 @@ import logging as log
 
 #Creates and Restores Backups of Homematic Links
 
+LIVE = 'live'
+
 
 def define_commandline_arguments():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     group = parser.add_argument_group('RPC Server')
     group.add_argument('-s', '--host', default="ccu", help="Address of rpc server")
     group.add_argument('-p', '--port', default="2000", help="port of xml service")
+    group.add_argument('-e', '--endpoint', action='append', help="host:port of an rpc server. Can be given more than once for a combined backup of several interfaces or CCUs (replaces -s and -p)")
+    group.add_argument('-b', '--batch-size', type=int, default=50, help="Number of calls per system.multicall request (1 disables batching)")
+    group.add_argument('-j', '--jobs', type=int, default=1, help="Number of concurrent connections to rpc server")
+    group.add_argument('--timeout', type=float, default=60, help="Timeout of rpc calls in seconds")
+    group.add_argument('--retries', type=int, default=3, help="Number of retries of rpc calls after connection errors")
+    group.add_argument('--gzip', action='store_true', help="Compress rpc requests and accept compressed responses")
     group = parser.add_argument_group('Files')
     group.add_argument('-n', '--name-file', default='homematic_manager_names.json', help="Namefile (JSON) for HM-Devices")
+    group.add_argument('--cache-dir', default=os.path.expanduser('~/.cache/hmbackup'), help="Directory for cached paramset descriptions (empty to disable)")
     group.add_argument('-f', '--backup_file', default='link_backup.json', help='Location of backup file')
+    group.add_argument('--mirror', action='store_true', help="Read devices and links of backups and snapshots from the mirror of mirror.py (in cache dir) if it is up to date")
+    group.add_argument('--mirror-max-age', type=float, default=600, help="Seconds without message from the CCU after which the mirror is considered stale")
+    group.add_argument('--history', help="Directory of the backup history. Every backup is also stored there as snapshot")
+    group.add_argument('--history-compress', action='store_true', help="Compress new objects in the backup history")
+    group.add_argument('--baseline', help="Baseline backup file for incremental backups (default: backup file)")
     group = parser.add_argument_group('Commands')
     megroup = group.add_mutually_exclusive_group()
     megroup.add_argument('-c', '--create-link-backup', action='store_true', help="Backup links")
     megroup.add_argument('-r', '--restore-link-backup', action='store_true', help="Restore links")
+    megroup.add_argument('--save-snapshot', metavar='SNAPSHOT', help="Save device and paramset descriptions of the network for offline validation")
+    megroup.add_argument('--list-snapshots', action='store_true', help="List the snapshots of the backup history")
+    megroup.add_argument('--diff-snapshots', nargs=2, metavar=('OLD', 'NEW'), help="Show the changed links between two snapshots of the backup history")
+    megroup.add_argument('--diff', nargs=2, metavar=('OLD', 'NEW'), help="Show the changed links from OLD to NEW. Each is a backup file or \"%s\" for the current links of the network"%LIVE)
+    megroup.add_argument('--validate', metavar='SNAPSHOT', help="Validate backup file against a saved snapshot without accessing the network")
+    group.add_argument('--snapshot', help="Restore from this snapshot of the backup history instead of the backup file")
+    group.add_argument('-i', '--incremental', action='store_true', help="Read only paramsets of links which changed since the baseline backup")
+    group.add_argument('--full', action='store_true', help="Read all paramsets even if --incremental is given")
+    group.add_argument('--plan', action='store_true', help="Print the operations of a restore without executing them")
+    group.add_argument('--device', action='append', help="Restore only links with this device as sender or receiver (address or serial number, can be given more than once)")
+    group.add_argument('--name-match', metavar='REGEX', help="Restore only links whose names (description in backup file) match this regular expression")
+    group.add_argument('--psetid', action='append', help="Restore only links with this paramset id (can be given more than once)")
+    group.add_argument('--resume', action='store_true', help="Continue an aborted restore. Operations recorded as done in the journal are skipped")
+    group.add_argument('--journal', help="Journal file of the restore (default: <backup file>.journal)")
+    group.add_argument('--stream', action='store_true', help="Read, plan and restore the backup file in windows of links instead of loading it completely (for very large backups)")
+    group.add_argument('--window', type=int, default=1000, help="Number of links per window of --stream")
+    group.add_argument('--radio-jobs', type=int, default=1, help="Maximum number of concurrent radio operations during restore (operations writing to the same device run one after another)")
+    group.add_argument('--wait-pending', type=float, default=0, metavar='SECONDS', help="Wait up to this time for sleeping (battery) devices to receive their configuration after a restore")
     group.add_argument('-w', '--wet-mode', action='store_true', help="Enables writes to homematic network")
     group.add_argument('-o', '--overwrite_files', action='store_true', help="Overwrite existing files")
+    group.add_argument('--json', action='store_true', help="Print the report of --diff or --diff-snapshots as JSON")
     group.add_argument('-v', '--verbosity', action='count', default=0)
+    group.add_argument('--profile', action='store_true', help="Print latency statistics of all rpc calls at the end")
+    group.add_argument('--profile-dump', help="Write the timing of all rpc calls to this file (.json or .csv)")
     return parser
 def check_options(options, parser):
-    pass
+    if (options.list_snapshots or options.diff_snapshots or options.snapshot) and not options.history:
+        parser.error('--history is required for snapshots')
 
 def check_file(filename, mode, overwrite=False, doopen=False):
     '''
@@ -79,169 +124,379 @@ def create_device_list(net, options):
     fd.write(pd.DataFrame(devdata).to_string().encode('utf-8'))
     fd.close()
 
+def as_list(net):
+    if isinstance(net, list):
+        return net
+    return [net]
+
 def restore_link_backup(net, options):
     '''
         Restores links from backupfile and writes them into the corresponding devices
-        net: Network object for accessing devices
-        options: Programm options
+        net: Network object for accessing devices or list of network objects (one per endpoint).
+             Links of a combined backup are restored to the endpoint named in their "iface" field.
+             Links without "iface" are restored to the first endpoint.
+        options: Programm options. With filters (--device, --name-match, --psetid) only the matching
+                 links are read from the backup file (using its index) and only their devices and
+                 links are read from the network.
+                 In wet mode every operation is recorded in a journal. With --resume the operations
+                 done according to the journal of an aborted restore are skipped.
+                 With --stream (and without filters) the backup file is restored window by window
+                 while it is read.
+        Returns True if no operation failed
     '''
     filename_links = options.backup_file
     log.info('restoring links from file "%s"', filename_links)
 
     #Load backupfile
-    fd = check_file(filename_links, 'r', doopen=True)    
-    try:
-        backup = json.load(fd)
-    except ValueError, e:
-        msg = 'Error while reading file %s: %s'%(filename_links, e)
-        log.error(msg)
-        fd.close()
-        raise EnvironmentError(msg)
-    fd.close
-    
-    paramsets = backup['Paramsets']
-    links = backup['Linklist']
-    existing_links = net.getLinks()
-    device_list = net.getDevices()
-    devices = dict( [(d.addr, d) for d in device_list] )
-    for rlink in links:
-        try:
-            sender = devices[rlink['sender']]
-            receiver = devices[rlink['receiver']]
-        except KeyError, e:
-            log.warn('address %s is not present in network. Check file "%s"'%(e, filename_links))
-            continue
-        
-        existing_link = None
-        for elink in existing_links:
-            if elink.sender.addr == sender.addr and elink.receiver.addr == receiver.addr:
-                existing_link = elink
-        
-        try:
-            pset = paramsets[unicode(rlink['psetid'])]
-        except KeyError, e:
-            log.error('Unknown reference to psetid %s. Check backup file'%(e))
+    check_file(filename_links, 'r')
+    restore_journal = None
+    if options.resume or options.wet_mode:
+        restore_journal = journal.RestoreJournal(options.journal or filename_links + '.journal', filename_links)
+        if options.resume:
+            restore_journal.load()
+    partial = bool(options.device or options.name_match or options.psetid)
+    if options.stream and not partial:
+        return stream_link_backup(as_list(net), filename_links, restore_journal, options)
+    if partial:
+        index = backupindex.BackupIndex(filename_links)
+        backup = index.select(options.device, options.name_match, options.psetid)
+        index.close()
+    else:
+        backup = load_backup(filename_links)
+
+    networks = as_list(net)
+    endpoints = OrderedDict( (n.name, list()) for n in networks )
+    for rlink in backup['Linklist']:
+        iface = rlink.get('iface', networks[0].name)
+        if iface not in endpoints:
+            log.warn('Link %s -> %s belongs to endpoint %s which is not given. Skipping it', rlink['sender'], rlink['receiver'], iface)
             continue
+        endpoints[iface].append(rlink)
 
-        if existing_link:
-            log.debug('Found link "%r" in network'%existing_link)
-            if rlink['delete']:
-                #Link is requested to be deleted
-                net.deleteLink(existing_link, not options.wet_mode)
-                existing_links.remove(existing_link)
-            else:
-                #Link does exists ==> update parameters
-                existing_link.setParamset(pset, not options.wet_mode)
-        elif rlink['delete']:
-            log.debug('Link does not exist and can not be deleted: %s->%s'%(sender, receiver))
+    def plan_endpoint(n):
+        if partial:
+            rlinks = endpoints[n.name]
+            existing_links = n.getLinksOf(sorted(set(l['receiver'] for l in rlinks)))
+            devices = n.getDevicesByAddress(sorted(set(a for l in rlinks for a in (l['sender'], l['receiver']))))
+        else:
+            existing_links = n.getLinks()
+            devices = dict( [(d.addr, d) for d in n.getDevices()] )
+        return restore.plan_restore({'Linklist':endpoints[n.name], 'Paramsets':backup['Paramsets']}, existing_links, devices)
+    plans = hmnet.parallel(plan_endpoint, networks, len(networks))
+    if options.resume:
+        for n, plan in zip(networks, plans):
+            plan.skip_done(restore_journal, n.name)
+            log.info('Resumed restore plan: %s', plan.summary())
+    if options.plan:
+        for n, plan in zip(networks, plans):
+            if len(networks) > 1:
+                sys.stdout.write('Endpoint %s:\n'%n.name)
+            plan.printout(sys.stdout)
+        return True
+    if not options.wet_mode:
+        executors = hmnet.parallel(lambda (n, plan): restore.apply_plan(n, plan, True, options.radio_jobs),
+                                   zip(networks, plans), len(networks))
+        return all(executor.complete() for executor in executors)
+
+    restore_journal.open(options.resume)
+    complete = False
+    try:
+        for n, plan in zip(networks, plans):
+            restore_journal.planned(n.name, plan)
+        executors = hmnet.parallel(lambda (n, plan): restore.apply_plan(n, plan, False, options.radio_jobs, restore_journal,
+                                                                        options.wait_pending),
+                                   zip(networks, plans), len(networks))
+        complete = all(executor.complete() for executor in executors)
+    finally:
+        restore_journal.close(complete)
+    return complete
+
+def stream_link_backup(networks, filename, restore_journal, options):
+    '''
+        Restores the backup file <filename> to <networks> without loading it completely.
+        Every endpoint reads the file on its own and restores its links in windows of
+        options.window links (see restore.stream_restore).
+        Returns True if no operation failed
+    '''
+    names = set(n.name for n in networks)
+    wet = options.wet_mode and not options.plan
+    def restore_endpoint(n):
+        with BackupReader(filename) as reader:
+            def entries():
+                for rlink in reader.links():
+                    iface = rlink.get('iface', networks[0].name)
+                    if iface == n.name:
+                        yield rlink
+                    elif iface not in names and n is networks[0]:
+                        log.warn('Link %s -> %s belongs to endpoint %s which is not given. Skipping it', rlink['sender'], rlink['receiver'], iface)
+            if options.plan and len(networks) > 1:
+                sys.stdout.write('Endpoint %s:\n'%n.name)
+            plan, executor = restore.stream_restore(n, entries(), reader.paramsets, not wet, options.window, options.radio_jobs,
+                                                    restore_journal, options.resume, sys.stdout if options.plan else None,
+                                                    options.wait_pending)
+        if options.plan:
+            sys.stdout.write(plan.summary() + '\n')
         else:
-            #Link does not exist and is not marked for deletion ==> Create link!
-            log.debug('Link "%s" not existing in network. It will be added'%existing_link)
-            new_link = HMLink(sender, receiver, pset, 0x00)
-            net.addLink(new_link, not options.wet_mode)
-            existing_links.append(new_link)
+            executor.log_summary()
+        return executor.complete()
+
+    if wet:
+        restore_journal.open(options.resume)
+    complete = False
+    try:
+        #Plans are printed one endpoint after another
+        complete = all(hmnet.parallel(restore_endpoint, networks, 1 if options.plan else len(networks)))
+    finally:
+        if wet:
+            restore_journal.close(complete)
+    return complete
+
+def read_links(net, options, baseline):
+    '''
+        Reads all links including their paramsets from <net>. With a <baseline> backup and
+        incremental mode only changed paramsets are read from the network.
+    '''
+    if baseline is not None:
+        log.info('Create incremental link backup of %s', net.name)
+        linklist = net.getLinks(with_paramsets=False)
+        reuse_baseline_paramsets(linklist, baseline, net.name)
+    else:
+        log.info('Create link backup of %s', net.name)
+        linklist = net.getLinks()
+    net.fetchParamsets(linklist)
+    return linklist
+
 def create_link_backup(net, options):    
     '''
         Creates the full link backup of all links in <net>
-        net: Network object to access all homematic devices
+        net: Network object to access all homematic devices or list of network objects (one per
+             endpoint). The links of all endpoints are written to one backup file. If there is more
+             than one endpoint every link is marked with the name of its endpoint ("iface").
         options: programm options
     '''
     filename_links = options.backup_file   
-    log.info('Create link backup')
-    linklist = net.getLinks()
-    paramsets = OrderedDict()
-    linkbackuplist = list()
-    for link in linklist:
-        #Get sorted pset of current link
-        pset = link.getParamset()
-        pset = OrderedDict( (k, pset[k]) for k in sorted(pset) )
-
-        #Insert pset of link into known paramsets if it's not in already
-        if pset not in paramsets.values():
-            pid = 0
-            while(str(pid) in paramsets.keys()):
-                pid += 1
-            paramsets[str(pid)] = pset
-
-        #Find paramset id for the given pset of link in all known paramsets
-        for key,value in paramsets.iteritems():
-            if value == pset:
-                paramset_id = key
-
-        #Mark broken links
-        br = ''
-        bs = ''
-        if link.link_broken_receiver():
-            br = '(*)'
-        if link.link_broken_senderside():
-            bs = '(*)'
-        us = bs + unicode(link.sender.username)
-        ur = br + unicode(link.receiver.username)
-
-        #Fill data fields
-        data = OrderedDict()
-        data['delete'] = False
-        data['psetid'] = paramset_id
-        data['desc'] = u'%-40s -> %-40s'%(us, ur)
-        data['sender'] = link.sender.addr
-        data['receiver'] = link.receiver.addr
-        linkbackuplist.append(data)
-
-    #Sort by paramset id and secondly by description
-    sortkey = lambda x: (x['psetid'], x['desc'])
-    linkbackuplist = sorted(linkbackuplist, key=sortkey)
-    
+    baseline_file = options.baseline or filename_links
+    baseline = None
+    if options.incremental and not options.full and os.path.exists(baseline_file):
+        log.info('Using baseline "%s"', baseline_file)
+        baseline = load_backup(baseline_file)
+
+    linkbackuplist, paramsets, devices = collect_backup(net, options, baseline)
     log.info('Found %d links and %d paramsets', len(linkbackuplist), len(paramsets))
     log.info('Write linklist to file "%s"', filename_links)
 
     #write json file
-    write_json(filename_links, linkbackuplist, paramsets, options.overwrite_files)
+    write_json(filename_links, linkbackuplist, paramsets.paramsets, devices, options.overwrite_files)
+    backupindex.BackupIndex(filename_links).close()
+    if options.history:
+        store = history.HistoryStore(options.history, options.history_compress, create=True)
+        store.add(linkbackuplist, paramsets.paramsets, devices, os.path.abspath(filename_links))
 
-def write_json(filename, links, paramsets, overwrite_flag):
+def collect_backup(net, options, baseline=None):
+    '''
+        Reads all links of <net> (network object or list of network objects) and returns the
+        content of a backup file as tuple of the sorted list of link entries, the ParamsetTable
+        and the dict of device metadata
+    '''
+    networks = as_list(net)
+    linklists = hmnet.parallel(lambda n: read_links(n, options, baseline), networks, len(networks))
+
+    paramsets = ParamsetTable()
+    linkbackuplist = list()
+    devices = dict()
+    for n, linklist in zip(networks, linklists):
+        for link in linklist:
+            devices[link.receiver.addr] = device_metadata(link.receiver)
+
+            #Insert pset of link into known paramsets and get its content derived id
+            paramset_id = paramsets.add(link.getParamset())
+
+            #Mark broken links
+            br = ''
+            bs = ''
+            if link.link_broken_receiver():
+                br = '(*)'
+            if link.link_broken_senderside():
+                bs = '(*)'
+            us = bs + unicode(link.sender.username)
+            ur = br + unicode(link.receiver.username)
+
+            #Fill data fields
+            data = OrderedDict()
+            data['delete'] = False
+            data['psetid'] = paramset_id
+            data['desc'] = u'%-40s -> %-40s'%(us, ur)
+            data['sender'] = link.sender.addr
+            data['receiver'] = link.receiver.addr
+            if len(networks) > 1:
+                data['iface'] = n.name
+            linkbackuplist.append(data)
+
+    #Sort by paramset id and secondly by description. Addresses make the order independent of the order of getLinks
+    return sorted(linkbackuplist, key=link_sortkey), paramsets, devices
+
+def device_metadata(dev):
+    '''
+        Metadata of device <dev> stored in the backup. A change of it invalidates the link
+        paramsets of the device for incremental backups.
+    '''
+    return OrderedDict( (k, dev.desc.get(k)) for k in ['VERSION', 'AES_ACTIVE'] )
+
+def reuse_baseline_paramsets(linklist, baseline, iface):
+    '''
+        Sets the receiver paramsets of all links in <linklist> of endpoint <iface> which are
+        unchanged since the backup <baseline>. Links which are new, broken or whose receiver
+        changed its metadata are left without paramset.
+    '''
+    paramsets = baseline.get('Paramsets', dict())
+    devices = baseline.get('Devices', dict())
+    known = dict( ((l['sender'], l['receiver']), unicode(l['psetid'])) for l in baseline['Linklist']
+                  if not l['delete'] and l.get('iface', iface) == iface )
+    reused = 0
+    for link in linklist:
+        psetid = known.get( (link.sender.addr, link.receiver.addr) )
+        if psetid not in paramsets or link.flags != 0:
+            continue
+        if devices.get(link.receiver.addr) != device_metadata(link.receiver):
+            continue
+        link.receiver_paramset = paramsets[psetid]
+        reused += 1
+    log.info('Reusing %d paramsets of baseline. Reading %d paramsets from network', reused, len(linklist) - reused)
+
+def write_json(filename, links, paramsets, devices, overwrite_flag):
     '''
         filename: Location and name of outputfile
         links: list of dicts. Each dict is a link with reference to a parameterset
         paramsets: dict of dicts: Paramsets sorted by parameterset reference
+        devices: dict of dicts: Metadata of receiver devices sorted by address
     '''
-    outstr = u'{"Linklist": [ \n'
-    for link in links:
-        outstr += '    ' + json.dumps(link, ensure_ascii=False) + ',\n'
-    outstr = outstr[:-2] + u'\n],'
-    outstr += u'"Paramsets": { \n'
-    for key in sorted(paramsets):
-        outstr += '    "%s":'%key
-        outstr += json.dumps(paramsets[key], ensure_ascii=False) + ',\n'
-    outstr = outstr[:-2] + u'\n}}'
-    fd = check_file(filename, 'w', overwrite_flag, doopen=True)
-    fd.write(outstr.encode('utf-8'))
-    fd.close()
+    check_file(filename, 'w', overwrite_flag)
+    with BackupWriter(filename) as writer:
+        for link in links:
+            writer.write_link(link)
+        writer.write_paramsets(paramsets)
+        writer.write_devices(devices)
 
 
-parser = define_commandline_arguments()
-options = parser.parse_args()
-check_options(options, parser)
+def diff_link_backups(net, options):
+    '''
+        Prints the changes of the links from options.diff[0] to options.diff[1]. Each of them is
+        a backup file or "live" for the current links of <net>.
+        Returns the number of changes.
+    '''
+    sides = list()
+    for name in options.diff:
+        if name == LIVE:
+            linkbackuplist, paramsets, devices = collect_backup(net, options)
+            sides.append({'Linklist':linkbackuplist, 'Paramsets':paramsets.paramsets})
+        else:
+            check_file(name, 'r')
+            sides.append(load_backup(name))
+    start = time.time()
+    changes = backupdiff.diff_backups(*sides)
+    log.debug('Compared %d with %d links in %.3fs', len(sides[0]['Linklist']), len(sides[1]['Linklist']), time.time() - start)
+    backupdiff.write_report(changes, sys.stdout, options.json)
+    return len(changes)
+
+def validate_link_backup(options):
+    '''
+        Validates the backup file offline against the snapshot file options.validate.
+        Returns the number of problems found.
+    '''
+    check_file(options.backup_file, 'r')
+    check_file(options.validate, 'r')
+    problems = validate.validate_backup(load_backup(options.backup_file), validate.load_snapshot(options.validate))
+    for sender, receiver, msg in problems:
+        log.error('%s -> %s: %s', sender, receiver, msg)
+    log.info('Validation of "%s" found %d problems', options.backup_file, len(problems))
+    return len(problems)
+
+def main(argv=None):
+    parser = define_commandline_arguments()
+    options = parser.parse_args(argv)
+    check_options(options, parser)
+
+    if options.verbosity == 0:
+        loglevel = log.INFO
+    elif options.verbosity == 1:
+        loglevel = log.DEBUG
+    else:
+        loglevel = log.DEBUG
 
-if options.verbosity == 0:
-    loglevel = log.INFO
-elif options.verbosity == 1:
-    loglevel = log.DEBUG
-else:
-    loglevel = log.DEBUG
+    log.basicConfig(format='[%(levelname)s] %(filename)s(%(lineno)s): %(message)s', level=loglevel)
 
-log.basicConfig(format='[%(levelname)s] %(filename)s(%(lineno)s): %(message)s', level=loglevel)
+    if options.validate:
+        try:
+            return 1 if validate_link_backup(options) else 0
+        except EnvironmentError, e:
+            log.error('Programm aborted')
+            log.error(e)
+            return 1
+    if options.list_snapshots or options.diff_snapshots:
+        try:
+            store = history.HistoryStore(options.history)
+            if options.list_snapshots:
+                store.printout(sys.stdout)
+            else:
+                backupdiff.write_report(store.diff(*options.diff_snapshots), sys.stdout, options.json)
+            return 0
+        except EnvironmentError, e:
+            log.error('Programm aborted')
+            log.error(e)
+            return 1
 
+    if options.diff and LIVE not in options.diff:
+        try:
+            return 1 if diff_link_backups(None, options) else 0
+        except EnvironmentError, e:
+            log.error('Programm aborted')
+            log.error(e)
+            return 1
+
+    endpoints = options.endpoint or ['%s:%s'%(options.host, options.port)]
 
-rpcaddress = 'http://%s:%s'%(options.host, options.port)
+    #Connect to Homematic networks
+    networks = list()
+    profile = None
+    if options.profile or options.profile_dump:
+        profile = rpcprofile.RPCProfile()
+    for endpoint in endpoints:
+        #A restore always compares against the live state of the network
+        mirror_file = None
+        if options.mirror and not options.restore_link_backup:
+            mirror_file = mirror.default_filename(options.cache_dir, endpoint)
+        HMNetwork = hmnet.network('http://%s'%endpoint, options.name_file, options.batch_size, options.jobs,
+                                  options.cache_dir, options.timeout, options.retries, options.gzip,
+                                  mirror_file, options.mirror_max_age)
+        HMNetwork.proxy.profile = profile
+        networks.append(HMNetwork)
 
-#Connect to Homematic networt
-HMNetwork = hmnet.network(rpcaddress, options.name_file)
+    result = 0
+    try:
+        if options.diff:
+            result = 1 if diff_link_backups(networks, options) else 0
+        if options.create_link_backup:
+#            create_device_list(HMNetwork, options)
+            create_link_backup(networks, options)
+        if options.restore_link_backup:
+            if options.snapshot:
+                options.backup_file = history.HistoryStore(options.history).checkout(options.snapshot)
+            if not restore_link_backup(networks, options):
+                result = 1
+        if options.save_snapshot:
+            validate.save_snapshot(networks, options.save_snapshot)
+    except EnvironmentError, e:
+        log.error('Programm aborted')
+        log.error(e)
+        result = 1
+    for HMNetwork in networks:
+        HMNetwork.proxy.log_transport_stats()
+    if options.profile:
+        profile.report(sys.stdout)
+    if options.profile_dump:
+        log.info('Write rpc timings to "%s"', options.profile_dump)
+        profile.dump(options.profile_dump)
+    return result
 
-try:
-    if options.create_link_backup:
-#        create_device_list(HMNetwork, options)
-        create_link_backup(HMNetwork, options)
-    if options.restore_link_backup:
-        restore_link_backup(HMNetwork, options)
-except EnvironmentError, e:
-    log.error('Programm aborted')
-    log.error(e)
+if __name__ == '__main__':
+    sys.exit(main())
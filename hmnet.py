@@ -1,71 +1,428 @@
 # -*- coding: utf-8 -*-
-import json
+import errno
+import os
 import xmlrpclib
-from devices import DeviceFactory, HMLink
-import pandas as pd
+import httplib
+import socket
+import threading
+import time
+import Queue
+import sys
+from devices import DeviceRegistry, HMDevice, HMLink, NameRegistry, ParamsetDescriptionCache
+from paramsets import ParamsetTable
+from backupfile import BackupWriter
+import linktable
+import mirror
+from rpcprofile import ProfiledMethod
 from collections import OrderedDict
 import logging as log
 
+class RPCBatch(object):
+    '''
+        Queue of xmlrpc calls which are sent to the network as system.multicall batches.
+        Every queued call gets a callback which is called with the result of the call
+        or with the xmlrpclib.Fault instance if the call failed within the batch.
+    '''
+    def __init__(self, net):
+        self.net = net
+        self.calls = list()
+        self.callbacks = list()
+    def add(self, callback, fkt, *args):
+        self.calls.append( (fkt, args) )
+        self.callbacks.append(callback)
+        if len(self.calls) >= self.net.batchsize:
+            self.flush()
+    def flush(self):
+        calls, callbacks = self.calls, self.callbacks
+        self.calls = list()
+        self.callbacks = list()
+        for callback, result in zip(callbacks, self.net.multicall(calls)):
+            callback(result)
+    def __len__(self):
+        return len(self.calls)
+
+#Methods which do not change the CCU. Calls of them are repeated after any connection error.
+READ_ONLY_METHODS = set(['listDevices', 'getDeviceDescription', 'getLinks', 'getLinkPeers', 'getParamset',
+                         'getParamsetDescription', 'getValue', 'ping', 'system.listMethods'])
+
+def is_read_only(request_body):
+    '''
+        True if the xmlrpc request <request_body> only calls READ_ONLY_METHODS (also within system.multicall)
+    '''
+    try:
+        params, method = xmlrpclib.loads(request_body)
+    except Exception:
+        return False
+    if method == 'system.multicall':
+        return all(call.get('methodName') in READ_ONLY_METHODS for call in params[0])
+    return method in READ_ONLY_METHODS
+
+class KeepAliveTransport(xmlrpclib.Transport):
+    '''
+        xmlrpc transport which keeps its http connection open for all calls.
+        Calls failing with a connection error are retried <retries> times on a new connection
+        with exponentially growing delay starting with <backoff> seconds. Calls which change the
+        CCU are only retried if they can not have reached it: the connection was refused or a
+        reused keep-alive connection was closed by the CCU. A timeout is never retried for them.
+        With <gzip> requests larger than 1 kB are compressed and compressed responses are accepted.
+        connections, requests and retries count the usage of the transport.
+    '''
+    def __init__(self, timeout=60, retries=3, backoff=0.5, gzip=False):
+        xmlrpclib.Transport.__init__(self)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.accept_gzip_encoding = gzip
+        if gzip:
+            self.encode_threshold = 1024
+        self.connections = 0
+        self.requests = 0
+        self.retried = 0
+        self.last_request_bytes = 0
+        self.last_response_bytes = 0
+        self.reused = False
+    def make_connection(self, host):
+        if self._connection and host == self._connection[0]:
+            self.reused = True
+            return self._connection[1]
+        self.reused = False
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        self._connection = host, httplib.HTTPConnection(chost, timeout=self.timeout)
+        self.connections += 1
+        return self._connection[1]
+    def request(self, host, handler, request_body, verbose=0):
+        attempt = 0
+        while True:
+            self.requests += 1
+            self.last_request_bytes = len(request_body)
+            self.last_response_bytes = 0
+            try:
+                return self.single_request(host, handler, request_body, verbose)
+            except (socket.error, httplib.HTTPException), e:
+                reused = self.reused
+                self.close()
+                if attempt >= self.retries or not self.may_retry(e, reused, request_body):
+                    raise
+                delay = self.backoff * 2**attempt
+                log.warn('Connection to %s failed (%s). Retry in %.1fs', host, e, delay)
+                time.sleep(delay)
+                attempt += 1
+                self.retried += 1
+    def may_retry(self, error, reused, request_body):
+        if isinstance(error, socket.error) and error.errno == errno.ECONNREFUSED:
+            return True
+        if reused and (isinstance(error, httplib.BadStatusLine) or
+                       isinstance(error, socket.error) and error.errno in (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)):
+            #Idle keep-alive connection closed by the CCU
+            return True
+        return is_read_only(request_body)
+    def parse_response(self, response):
+        self.last_response_bytes = int(response.getheader('content-length', 0) or 0)
+        return xmlrpclib.Transport.parse_response(self, response)
+
+class PooledMethod(object):
+    '''
+        Callable for the rpc method <name> of a ThreadProxy
+    '''
+    def __init__(self, proxy, name):
+        self.proxy = proxy
+        self.name = name
+    def __getattr__(self, name):
+        return PooledMethod(self.proxy, '%s.%s'%(self.name, name))
+    def __call__(self, *args):
+        serverproxy, transport = self.proxy.acquire()
+        try:
+            return getattr(serverproxy, self.name)(*args)
+        finally:
+            self.proxy.release( (serverproxy, transport) )
+
+class ThreadProxy(object):
+    '''
+        xmlrpclib.ServerProxy is not thread safe. ThreadProxy behaves like a ServerProxy but
+        executes every call with a ServerProxy taken from a pool of idle connections, each with
+        its own KeepAliveTransport. A connection is returned to the pool after the call and reused
+        by later calls of any thread, so short lived worker threads do not open new connections.
+        The pool grows to the maximum number of concurrent calls.
+        If <profile> is set to a rpcprofile.RPCProfile every call is recorded in it.
+    '''
+    def __init__(self, rpcaddr, **transport_options):
+        self.rpcaddr = rpcaddr
+        self.profile = None
+        self.transport_options = transport_options
+        self.transports = list()
+        self.idle = list()
+        self.lock = threading.Lock()
+    def acquire(self):
+        '''
+            Returns an idle (ServerProxy, KeepAliveTransport) pair. It must be given back with release().
+        '''
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        transport = KeepAliveTransport(**self.transport_options)
+        with self.lock:
+            self.transports.append(transport)
+        return xmlrpclib.ServerProxy(self.rpcaddr, transport=transport), transport
+    def release(self, connection):
+        with self.lock:
+            self.idle.append(connection)
+    def log_transport_stats(self):
+        requests = sum(t.requests for t in self.transports)
+        log.info('Connection pool %s: %d requests over %d connections (%.1f requests per connection) of %d transports, %d retries',
+                 self.rpcaddr, requests, sum(t.connections for t in self.transports),
+                 requests / float(max(1, sum(t.connections for t in self.transports))), len(self.transports),
+                 sum(t.retried for t in self.transports))
+    def __getattr__(self, name):
+        if self.profile is not None:
+            return ProfiledMethod(self, name, self.profile)
+        return PooledMethod(self, name)
+
+def parallel(fkt, items, jobs):
+    '''
+        Calls <fkt> for every element of <items> with up to <jobs> worker threads.
+        Returns the list of results in the order of <items>. The first exception raised
+        by a worker is raised again after all workers finished.
+    '''
+    items = list(items)
+    if jobs == 1 or len(items) <= 1:
+        return [fkt(item) for item in items]
+    results = [None] * len(items)
+    errors = list()
+    todo = Queue.Queue()
+    for idx, item in enumerate(items):
+        todo.put( (idx, item) )
+    def worker():
+        while not errors:
+            try:
+                idx, item = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[idx] = fkt(item)
+            except Exception:
+                errors.append(sys.exc_info())
+    threads = [threading.Thread(target=worker) for i in range(min(jobs, len(items)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
 class network:
-    def __init__(self, rpcaddr, namefile):
+    def __init__(self, rpcaddr, namefile, batchsize=50, jobs=1, cache_dir=None, timeout=60, retries=3, gzip=False,
+                 mirror_file=None, mirror_max_age=600):
         self.rpcaddr = rpcaddr
+        self.name = rpcaddr.split('://')[-1]
         self.namefile = namefile
-        self.proxy = xmlrpclib.ServerProxy(rpcaddr)
+        self.names = NameRegistry.get(namefile)
+        self.batchsize = max(1, batchsize)
+        self.jobs = max(1, jobs)
+        self.proxy = ThreadProxy(rpcaddr, timeout=timeout, retries=retries, gzip=gzip)
+        self.devices = DeviceRegistry(self.proxy, self.names)
+        if cache_dir:
+            HMDevice.PARAMSET_INFO.load(os.path.join(cache_dir, 'paramset_descriptions.json'))
+        #Devices and links are served from the mirror (see mirror.py) if it is up to date
+        self.mirror = None
+        if mirror_file:
+            self.mirror = mirror.load_mirror(mirror_file, self.name, mirror_max_age)
+        if self.mirror is not None:
+            self.devices.load(self.mirror['Devices'])
         log.info('Connected to serveraddress "%s"', rpcaddr)
+    def parallel(self, fkt, items):
+        '''
+            Calls <fkt> for every element of <items> with up to <jobs> worker threads.
+            Returns the list of results in the order of <items>.
+        '''
+        return parallel(fkt, items, self.jobs)
+    def multicall(self, calls):
+        '''
+            Executes the list of (function, args) tuples <calls> in batches of <batchsize> calls.
+            The batches are sent concurrently by up to <jobs> workers.
+            Returns the list of results in the order of <calls>. Failed calls are reported
+            per call as xmlrpclib.Fault instances at their position in the result list.
+        '''
+        chunks = [calls[start:start+self.batchsize] for start in range(0, len(calls), self.batchsize)]
+        results = list()
+        for chunkresults in self.parallel(self._multicall_chunk, chunks):
+            results.extend(chunkresults)
+        return results
+    def _multicall_chunk(self, calls):
+        if self.batchsize == 1 or len(calls) == 1:
+            results = list()
+            for fkt, args in calls:
+                try:
+                    results.append(getattr(self.proxy, fkt)(*args))
+                except xmlrpclib.Fault, e:
+                    results.append(e)
+            return results
+        log.debug('Calling system.multicall with %d calls', len(calls))
+        mcargs = [{'methodName':fkt, 'params':list(args)} for fkt, args in calls]
+        try:
+            response = self.proxy.system.multicall(mcargs)
+        except xmlrpclib.Fault, e:
+            log.warn('system.multicall is not supported by "%s" (%s). Falling back to single calls', self.rpcaddr, e)
+            self.batchsize = 1
+            return self._multicall_chunk(calls)
+        results = list()
+        for r in response:
+            if type(r) == dict:
+                results.append(xmlrpclib.Fault(r['faultCode'], r['faultString']))
+            else:
+                results.append(r[0])
+        return results
+    def batch(self):
+        return RPCBatch(self)
     def getDevices(self):
-        result = self.proxy.listDevices()
-        devlist = [DeviceFactory(desc, self.proxy, self.namefile) for desc in result]
-        return devlist
+        return self.devices.all()
+    def refreshDevices(self):
+        self.devices.refresh()
+        return self.devices.all()
     def getLinksSlow(self):
-        alllinks = list()
-        for dev in self.getDevices():
-            peers = dev.get_link_peers()
+        devlist = self.getDevices()
+        peerlists = self.multicall([('getLinkPeers', (d.addr,)) for d in devlist])
+        candidates = list()
+        for receiver, peers in zip(devlist, peerlists):
+            if isinstance(peers, xmlrpclib.Fault):
+                continue
             for peer in peers:
-                receiver = dev
-                sender = peer
-                try:
-                    pset = self.proxy.getParamset(receiver.addr, sender.addr)
-                except:
-                    continue
-                
-                if len(pset) == 0:
-                    continue
-                link = HMLink(sender, receiver)
-                if link in alllinks:
-                    continue
-                alllinks.append(link)
+                candidates.append( (self.devices.get(peer), receiver) )
+
+        psets = self.multicall([('getParamset', (receiver.addr, sender.addr)) for sender, receiver in candidates])
+        alllinks = list()
+        known = set()
+        for (sender, receiver), pset in zip(candidates, psets):
+            if isinstance(pset, xmlrpclib.Fault) or len(pset) == 0:
+                continue
+            if (sender.addr, receiver.addr) in known:
+                continue
+            known.add( (sender.addr, receiver.addr) )
+            alllinks.append(HMLink(sender, receiver, pset, 0x00))
         return alllinks
-    def getLinks(self):
-        result = self.proxy.getLinks("", 0x4)
-        devlist = self.getDevices()
-        devdict = dict( [(d.addr, d) for d in devlist] )
+    def getLinks(self, with_paramsets=True):
+        '''
+            Returns all links of the network. Without <with_paramsets> the links are read
+            without their receiver paramsets which is much cheaper.
+        '''
+        if self.mirror is not None:
+            result = self.mirror['Links']
+        elif with_paramsets:
+            result = self.proxy.getLinks("", 0x4)
+        else:
+            result = self.proxy.getLinks("", 0x0)
+        self.devices.all()
         links = list()
         for r in result:
-            sender = devdict[r['SENDER']]
-            receiver = devdict[r['RECEIVER']]
-            receiver_paramset = r['RECEIVER_PARAMSET']
+            sender = self.devices.get(r['SENDER'])
+            receiver = self.devices.get(r['RECEIVER'])
+            receiver_paramset = r.get('RECEIVER_PARAMSET')
             links.append( HMLink(sender, receiver, receiver_paramset, r['FLAGS']) )
         return links
+    def getDevicesByAddress(self, addresses):
+        '''
+            Reads the descriptions of the devices (and their parent devices) with the given <addresses>
+            in batches without reading the whole device list.
+            Returns a dict of HMDevice by address of all devices present in the network.
+        '''
+        wanted = set(addresses)
+        wanted.update(addr.split(':')[0] for addr in addresses)
+        unknown = sorted(addr for addr in wanted if addr not in self.devices)
+        descriptions = self.multicall([('getDeviceDescription', (addr,)) for addr in unknown])
+        self.devices.add([d for d in descriptions if not isinstance(d, xmlrpclib.Fault)])
+        return dict( (addr, self.devices.get(addr)) for addr in addresses if addr in self.devices )
+    def getLinksOf(self, addresses, with_paramsets=True):
+        '''
+            Returns the links which have one of <addresses> as sender or receiver.
+            Only the links and devices of these addresses are read from the network.
+        '''
+        flags = 0x4 if with_paramsets else 0x0
+        results = self.multicall([('getLinks', (addr, flags)) for addr in addresses])
+        found = OrderedDict()
+        for addr, result in zip(addresses, results):
+            if isinstance(result, xmlrpclib.Fault):
+                log.warn('Cannot read links of %s: %s', addr, result)
+                continue
+            for r in result:
+                found[(r['SENDER'], r['RECEIVER'])] = r
+        self.getDevicesByAddress(sorted(set(a for key in found for a in key)))
+        links = list()
+        for r in found.itervalues():
+            links.append( HMLink(self.devices.get(r['SENDER']), self.devices.get(r['RECEIVER']), r.get('RECEIVER_PARAMSET'), r['FLAGS']) )
+        return links
+    def fetchParamsets(self, links, reread_from_network=False):
+        '''
+            Reads the receiver paramsets of all <links> without paramset (or all of them if
+            <reread_from_network> is set) with batched calls and stores them in the links.
+        '''
+        batch = self.batch()
+        failed = list()
+        def store(link):
+            def callback(result):
+                if isinstance(result, xmlrpclib.Fault):
+                    log.error('Communication error while reading paramset of link %r: %s', link, result)
+                    failed.append(link)
+                else:
+                    link.receiver_paramset = result
+            return callback
+        for link in links:
+            if reread_from_network or not link.receiver_paramset:
+                batch.add(store(link), 'getParamset', link.receiver.addr, link.sender.addr)
+        batch.flush()
+        if failed:
+            raise EnvironmentError('Reading paramsets of %d links failed'%len(failed))
+    def fetchParamsetInfo(self, devices, paramset_name):
+        '''
+            Reads the paramset descriptions <paramset_name> of all device types in <devices>
+            which are not cached yet with batched calls
+        '''
+        batch = self.batch()
+        queued = set()
+        def store(dev):
+            def callback(result):
+                if isinstance(result, xmlrpclib.Fault):
+                    log.error('Communication error while reading paramset description of %r: %s', dev, result)
+                else:
+                    dev.store_paramset_info(paramset_name, result)
+            return callback
+        for dev in devices:
+            key = ParamsetDescriptionCache.key(dev.desc, paramset_name)
+            if dev.has_paramset_info(paramset_name) or key in queued:
+                continue
+            queued.add(key)
+            batch.add(store(dev), 'getParamsetDescription', dev.addr, paramset_name)
+        batch.flush()
+        HMDevice.PARAMSET_INFO.save()
     def callproxy(self, fkt, *args):
-        callstr = '%s(%s)'%(fkt, '"' + '", "'.join(args) + '"')
-        log.debug('Calling %s'%callstr)
-        eval('self.proxy.%s'%callstr)
-    def addLink(self, link, drymode):
+        log.debug('Calling %s%r', fkt, args)
+        return getattr(self.proxy, fkt)(*args)
+    def addLink(self, link, drymode, stats=None):
+        '''
+            Creates <link> and writes its paramset. A link whose paramset can not be written is
+            not deleted again since it may already be partly written. A repeated (resumed) restore
+            updates its paramset. Returns False on failure.
+        '''
         if drymode:
             log.info('Would add link to network: "%s"'%link)
         else:
             log.info('Add link to network: "%s"'%link)
             name = ''
             description = 'Created with hmnet.py'
+            pset = link.receiver_paramset
             try:
                 self.callproxy('addLink', link.sender.addr, link.receiver.addr, name, description)
 #                self.proxy.addLink(link.sender.addr, link.receiver.addr, name, description)
-                pset = link.receiver_paramset
-                link.getParamset(reread_from_network=True)
-                link.setParamset(pset, False)
             except xmlrpclib.Fault,e:
-                log.error('Communication failure while adding link. Try revert action. :%s'%e)
-                self.deleteLink(link, False)
+                log.error('Communication failure while adding link: %s'%e)
+                return False
+            try:
+                link.getParamset(reread_from_network=True)
+                link.setParamset(pset, False, stats=stats)
+            except EnvironmentError, e:
+                log.error('Link "%s" was added but its paramset could not be written: %s'%(link, e))
+                return False
+        return True
     def deleteLink(self, link, drymode):
         if drymode:
             log.info('Would delete link from network: "%s"'%link)
@@ -75,71 +432,37 @@ class network:
                 self.callproxy('removeLink', link.sender.addr, link.receiver.addr)
             except xmlrpclib.Fault,e:
                 log.error('Communication failure while deleting link.')
+                return False
+        return True
 
     def dumpLinksToFile(self, filename):
-        dataset = OrderedDict()        
-        dataset['links'] = list()
-        
         links = self.getLinks()
-        paramsets = list()
+        self.fetchParamsets(links)
+        paramsets = ParamsetTable()
         linkoutputlist = list()
-        with open(filename, 'w') as fd:
-            for link in links:
-                data = OrderedDict()
-                pset = link.getParamset()
-                if pset not in paramsets:
-                    paramsets.append(pset)
-                data['psetid'] = paramsets.index(pset)
-                data['desc'] = '%-40s -> %-40s'%(link.sender.username, link.receiver.username)
-                data['sender'] = link.sender.addr
-                data['receiver'] = link.receiver.addr
-                linkoutputlist.append(data)
-            linkoutputlist = sorted(linkoutputlist, key=lambda x: (x['psetid'], x['desc']))
-            dataset['links'] = linkoutputlist
+        for link in links:
+            data = OrderedDict()
+            data['delete'] = False
+            data['psetid'] = paramsets.add(link.getParamset())
+            data['desc'] = u'%-40s -> %-40s'%(link.sender.username, link.receiver.username)
+            data['sender'] = link.sender.addr
+            data['receiver'] = link.receiver.addr
+            linkoutputlist.append(data)
+        linkoutputlist = sorted(linkoutputlist, key=lambda x: (x['psetid'], x['desc']))
 
-            paramsetlist = list()
-            for idx, pset in enumerate(paramsets):
-                data = OrderedDict()
-                data['id'] = idx
-                data['paramset'] = pset
-                paramsetlist.append(data)
-            dataset['paramsets'] = paramsetlist
+        with BackupWriter(filename) as writer:
+            for data in linkoutputlist:
+                writer.write_link(data)
+            writer.write_paramsets(paramsets.paramsets)
 
-            outstr = json.dumps(dataset, ensure_ascii=False)
-            outstr = outstr.replace('{"psetid"', '\n    {"psetid"')
-            outstr = outstr.replace(' "paramsets"', '\n "paramsets"')
-            outstr = outstr.replace('{"id"', '\n    {"id"')
-            outstr = outstr.replace(']', '\n]')
-            fd.write(outstr.encode('utf-8'))
-            fd.write('\n')
-            
     def getLinkTable(self):
+        '''
+            Returns a pandas DataFrame of all links with one column per paramset key.
+            See module linktable for queries on the table.
+        '''
         links = self.getLinks()
-        keys = ['sender', 'receiver', 'SHORT_ACTION_TYPE', 'LONG_ACTION_TYPE']
-        tbldict = OrderedDict()
-        indexcolumn = list()
-        for (idxlink, link) in enumerate(links):
-            pset = link.getParamset()
-            #extract the keys of the paramset as a set
-            for k in pset.keys():
-                if k not in keys:
-                    keys.append(k)
-            for key in keys:
-                if key not in tbldict:
-                    emptylist = [None] * idxlink
-                    tbldict[key] = emptylist
-                if key == 'sender':
-                    value = link.sender.addr
-                elif key == 'receiver':
-                    value = link.receiver.addr
-                elif key not in pset:
-                    value = None
-                else:
-                    value = pset[key]
-                tbldict[key].append(value)
-            indexcolumn.append(u'%s -> %s'%(link.sender.username, link.receiver.username))
-        df = pd.DataFrame(tbldict, index=indexcolumn)
-        return df
+        self.fetchParamsets(links)
+        return linktable.build_link_table(links)
         
 if __name__ == '__main__':
     net = network('http://ccu:2000', 'names.json')
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import threading
+import logging as log
+
+#Write ahead journal of the operations of a restore
+
+def file_hash(filename):
+    '''
+        SHA1 of the content of <filename>
+    '''
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1 << 16), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def operation_key(iface, op):
+    return [iface, op.action, op.link.sender.addr, op.link.receiver.addr, unicode(op.psetid)]
+
+class RestoreJournal(object):
+    '''
+        Journal file with one JSON record per line. The first record names the backup file and its hash.
+        Every planned operation is recorded before the restore starts, every operation is recorded
+        when it is started and when it is done or failed. Each record is flushed to disk before the
+        radio operation is executed, so the journal shows what was finished after an abort.
+    '''
+    def __init__(self, filename, backup_file):
+        self.filename = filename
+        self.backup_file = backup_file
+        self.backup_hash = file_hash(backup_file)
+        self.done = set()
+        self.failed = set()
+        self.started = set()
+        self.fd = None
+        self.lock = threading.Lock()
+    def load(self):
+        '''
+            Reads the journal of an aborted restore. Raises EnvironmentError if there is no journal
+            or if it belongs to another version of the backup file.
+        '''
+        if not os.path.exists(self.filename):
+            raise EnvironmentError('Journal "%s" does not exist. Nothing to resume'%self.filename)
+        with open(self.filename) as fd:
+            records = list()
+            for line in fd:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    #Last record may be incomplete after a crash
+                    log.warn('Ignoring damaged record in journal "%s"', self.filename)
+        if not records or records[0].get('record') != 'header':
+            raise EnvironmentError('Journal "%s" has no header'%self.filename)
+        if records[0]['backup_hash'] != self.backup_hash:
+            raise EnvironmentError('Backup file "%s" changed since the journal "%s" was written. Refusing to resume'%(
+                                   self.backup_file, self.filename))
+        for r in records[1:]:
+            key = tuple(r.get('op', ()))
+            if r['record'] == 'started':
+                self.started.add(key)
+            elif r['record'] == 'done':
+                self.done.add(key)
+            elif r['record'] == 'failed':
+                self.failed.add(key)
+        log.info('Journal "%s": %d operations done, %d failed, %d interrupted', self.filename,
+                 len(self.done), len(self.failed - self.done), len(self.started - self.done - self.failed))
+    def open(self, resume=False):
+        '''
+            Opens the journal for writing. Without <resume> a new journal is started.
+        '''
+        self.fd = open(self.filename, 'a' if resume else 'w')
+        if not resume:
+            self.write({'record':'header', 'backup':os.path.abspath(self.backup_file), 'backup_hash':self.backup_hash})
+    def write(self, record):
+        with self.lock:
+            self.fd.write(json.dumps(record) + '\n')
+            self.fd.flush()
+            os.fsync(self.fd.fileno())
+    def is_done(self, iface, op):
+        return tuple(operation_key(iface, op)) in self.done
+    def was_interrupted(self, iface, op):
+        '''
+            True if <op> was started but neither done nor failed, e.g. because the program was aborted
+        '''
+        key = tuple(operation_key(iface, op))
+        return key in self.started and key not in self.done and key not in self.failed
+    def planned(self, iface, plan):
+        for op in plan.operations:
+            self.write({'record':'planned', 'op':operation_key(iface, op)})
+    def started_op(self, iface, op):
+        self.write({'record':'started', 'op':operation_key(iface, op)})
+    def finished_op(self, iface, op, error=None):
+        if error is None:
+            self.write({'record':'done', 'op':operation_key(iface, op)})
+        else:
+            self.write({'record':'failed', 'op':operation_key(iface, op), 'error':error})
+    def close(self, complete=False):
+        '''
+            Closes the journal. A journal of a complete restore without failures is removed.
+        '''
+        if self.fd is None:
+            return
+        self.fd.close()
+        self.fd = None
+        if complete:
+            log.info('Restore complete. Removing journal "%s"', self.filename)
+            os.remove(self.filename)
+        else:
+            log.warn('Restore not complete. Use --resume to continue with journal "%s"', self.filename)
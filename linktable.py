@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+from paramsets import ParamsetTable
+
+#Tabular view (pandas DataFrame) of links and their paramsets
+
+KEY_COLUMNS = ['sender', 'receiver', 'psetid', 'SHORT_ACTION_TYPE', 'LONG_ACTION_TYPE']
+CATEGORY_COLUMNS = ['sender', 'receiver', 'psetid', 'SHORT_ACTION_TYPE', 'LONG_ACTION_TYPE']
+
+def build_link_table(links):
+    '''
+        Builds a DataFrame with one row per link and one column per paramset key.
+        The row index is "<sender name> -> <receiver name>". Besides the paramset keys the
+        columns sender, receiver and psetid (content derived id of the paramset) are present.
+        The paramset columns are built once per distinct paramset and expanded by psetid.
+    '''
+    paramsets = ParamsetTable()
+    senders = list()
+    receivers = list()
+    psetids = list()
+    index = list()
+    for link in links:
+        senders.append(link.sender.addr)
+        receivers.append(link.receiver.addr)
+        psetids.append(paramsets.add(link.getParamset()))
+        index.append(u'%s -> %s'%(link.sender.username, link.receiver.username))
+
+    if len(index) == 0:
+        return pd.DataFrame(columns=KEY_COLUMNS)
+    psets = pd.DataFrame.from_dict(paramsets.paramsets, orient='index')
+    df = psets.reindex(psetids)
+    df.index = index
+    df['sender'] = senders
+    df['receiver'] = receivers
+    df['psetid'] = psetids
+    keys = [k for k in KEY_COLUMNS if k in df.columns]
+    df = df[keys + sorted(set(df.columns) - set(keys))]
+    for column in CATEGORY_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    return df
+
+def paramset_groups(df):
+    '''
+        Returns a DataFrame with the number of links and the receivers per paramset id,
+        sorted by the number of links (most used first)
+    '''
+    grouped = df.groupby('psetid', observed=True)
+    result = pd.DataFrame({'links': grouped.size(),
+                           'receivers': grouped['receiver'].nunique()})
+    return result.sort_values('links', ascending=False)
+
+def find_outliers(df, max_links=1):
+    '''
+        Returns all links whose paramset is used by at most <max_links> links
+    '''
+    counts = df['psetid'].map(df['psetid'].value_counts())
+    return df[counts.astype(int) <= max_links]
+
+def parameter_outliers(df, key):
+    '''
+        Returns all links whose value of parameter <key> differs from the most common value
+    '''
+    column = df[key]
+    mode = column.mode()
+    if len(mode) == 0:
+        return df.iloc[0:0]
+    return df[column.notnull() & (column != mode.iloc[0])]
+
+def filter_links(df, **conditions):
+    '''
+        Returns all links matching all <conditions>. A condition is either a value
+        (key=value), a list of allowed values or a function returning a boolean mask
+        for the column (e.g. SHORT_ON_TIME=lambda c: c > 60).
+    '''
+    mask = pd.Series(True, index=df.index)
+    for key, condition in conditions.iteritems():
+        column = df[key]
+        if callable(condition):
+            mask &= condition(column).values
+        elif isinstance(condition, (list, tuple, set)):
+            mask &= column.isin(condition).values
+        else:
+            mask &= (column == condition).values
+    return df[mask.values]
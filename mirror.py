@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import Queue
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import SocketServer
+import SimpleXMLRPCServer
+import xmlrpclib
+from collections import OrderedDict
+
+import logging as log
+
+#Local mirror of devices, links and link paramsets of a CCU interface kept up to date by xmlrpc callbacks
+
+CALLBACKS = ['event', 'listDevices', 'newDevices', 'deleteDevices', 'updateDevice', 'replaceDevice', 'readdedDevice']
+
+def default_filename(cache_dir, endpoint):
+    return os.path.join(cache_dir, 'mirror-%s.json'%endpoint.replace(':', '_').replace('/', '_'))
+
+def serial(addr):
+    return addr.split(':')[0]
+
+def link_key(link):
+    return '%s|%s'%(link['SENDER'], link['RECEIVER'])
+
+def load_mirror(filename, endpoint, max_age):
+    '''
+        Returns the mirror snapshot of <endpoint> in <filename> or None if it does not exist or
+        is stale, i.e. the mirror did not receive anything from the CCU for more than <max_age> seconds
+        or it failed to read changes from the CCU.
+    '''
+    if not os.path.exists(filename):
+        log.info('No mirror "%s". Using live calls', filename)
+        return None
+    try:
+        with open(filename) as fd:
+            snapshot = json.load(fd)
+    except ValueError, e:
+        log.warn('Ignoring damaged mirror "%s": %s', filename, e)
+        return None
+    if snapshot.get('Endpoint') != endpoint:
+        log.warn('Mirror "%s" belongs to endpoint %s. Using live calls', filename, snapshot.get('Endpoint'))
+        return None
+    if snapshot.get('Error'):
+        log.warn('Mirror "%s" is not up to date (%s). Using live calls', filename, snapshot['Error'])
+        return None
+    age = time.time() - snapshot['Heartbeat']
+    if age > max_age:
+        log.warn('Mirror "%s" is stale (last message from CCU %.0fs ago). Using live calls', filename, age)
+        return None
+    log.info('Using mirror "%s" with %d devices and %d links', filename, len(snapshot['Devices']), len(snapshot['Links']))
+    return snapshot
+
+class Mirror(object):
+    '''
+        Devices and links (with receiver paramsets) of the network <net>.
+        The xmlrpc callback methods of the CCU (event, newDevices, deleteDevices, updateDevice, ...)
+        only queue the affected devices. process() rereads their descriptions and links.
+        heartbeat: Time of the last message received from the CCU
+        error: Error of the last failed read from the CCU (None if the mirror is up to date)
+    '''
+    def __init__(self, net, filename):
+        self.net = net
+        self.filename = filename
+        self.devices = OrderedDict()
+        self.links = OrderedDict()
+        self.heartbeat = 0
+        self.synced = 0
+        self.dirty = False
+        self.error = None
+        self.pending = Queue.Queue()
+        self.lock = threading.RLock()
+
+    def full_sync(self):
+        '''
+            Rereads all devices and links from the CCU
+        '''
+        start = time.time()
+        devices = self.net.proxy.listDevices()
+        links = self.net.proxy.getLinks('', 0x4)
+        with self.lock:
+            self.devices = OrderedDict( (d['ADDRESS'], d) for d in devices )
+            self.links = OrderedDict( (link_key(l), l) for l in links )
+            self.synced = start
+            self.heartbeat = max(self.heartbeat, start)
+            self.error = None
+            self.dirty = True
+        log.info('Mirrored %d devices and %d links', len(devices), len(links))
+    def sync_devices(self, serials):
+        '''
+            Rereads the descriptions and links of the devices (serial numbers) <serials> and their channels
+        '''
+        serials = sorted(set(serials))
+        descriptions = self.net.multicall([('getDeviceDescription', (s,)) for s in serials])
+        children = list()
+        for desc in descriptions:
+            if not isinstance(desc, xmlrpclib.Fault):
+                children.extend(desc.get('CHILDREN', []))
+        channels = self.net.multicall([('getDeviceDescription', (c,)) for c in children])
+        linklists = self.net.multicall([('getLinks', (s, 0x4)) for s in serials])
+        with self.lock:
+            for s, desc, links in zip(serials, descriptions, linklists):
+                if isinstance(desc, xmlrpclib.Fault):
+                    self.remove_devices([s])
+                    continue
+                self.devices[s] = desc
+                for key in [k for k, l in self.links.items() if s in (serial(l['SENDER']), serial(l['RECEIVER']))]:
+                    del self.links[key]
+                if not isinstance(links, xmlrpclib.Fault):
+                    self.links.update( (link_key(l), l) for l in links )
+            for desc in channels:
+                if not isinstance(desc, xmlrpclib.Fault):
+                    self.devices[desc['ADDRESS']] = desc
+            self.error = None
+            self.dirty = True
+        log.info('Updated mirror of %s', ', '.join(serials))
+    def failed(self, error):
+        '''
+            Marks the mirror as not up to date until it is read successfully again
+        '''
+        with self.lock:
+            self.error = str(error) or error.__class__.__name__
+            self.dirty = True
+    def remove_devices(self, addresses):
+        with self.lock:
+            serials = set(serial(a) for a in addresses)
+            for addr in [a for a in self.devices if serial(a) in serials]:
+                del self.devices[addr]
+            for key in [k for k, l in self.links.items() if serial(l['SENDER']) in serials or serial(l['RECEIVER']) in serials]:
+                del self.links[key]
+            self.dirty = True
+
+    def process(self, timeout=1.0):
+        '''
+            Waits up to <timeout> seconds for queued devices and rereads all queued devices.
+            If reading fails the devices are queued again.
+        '''
+        try:
+            serials = [self.pending.get(timeout=timeout)]
+        except Queue.Empty:
+            return
+        while True:
+            try:
+                serials.append(self.pending.get_nowait())
+            except Queue.Empty:
+                break
+        try:
+            self.sync_devices(serials)
+        except Exception:
+            for s in set(serials):
+                self.pending.put(s)
+            raise
+
+    def save(self):
+        with self.lock:
+            snapshot = OrderedDict([('Endpoint', self.net.name), ('Heartbeat', self.heartbeat), ('Synced', self.synced), ('Error', self.error),
+                                    ('Devices', self.devices.values()), ('Links', self.links.values())])
+            path = os.path.dirname(os.path.abspath(self.filename))
+            if not os.path.exists(path):
+                os.makedirs(path)
+            fd, tmpname = tempfile.mkstemp(prefix='.%s.'%os.path.basename(self.filename), suffix='.tmp', dir=path)
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump(snapshot, tmp)
+            os.rename(tmpname, self.filename)
+            self.dirty = False
+
+    #Callbacks of the CCU
+    def alive(self):
+        with self.lock:
+            self.heartbeat = time.time()
+    def event(self, interface_id, address, value_key, value):
+        self.alive()
+        if value_key == 'CONFIG_PENDING' and not value:
+            #Configuration was transferred to the device
+            self.pending.put(serial(address))
+        return ''
+    def listDevices(self, interface_id):
+        self.alive()
+        with self.lock:
+            return [{'ADDRESS':d['ADDRESS'], 'VERSION':d.get('VERSION', 0)} for d in self.devices.values()]
+    def newDevices(self, interface_id, descriptions):
+        self.alive()
+        with self.lock:
+            for desc in descriptions:
+                self.devices[desc['ADDRESS']] = desc
+            self.dirty = True
+        for desc in descriptions:
+            self.pending.put(serial(desc['ADDRESS']))
+        return ''
+    def deleteDevices(self, interface_id, addresses):
+        self.alive()
+        self.remove_devices(addresses)
+        return ''
+    def updateDevice(self, interface_id, address, hint):
+        self.alive()
+        self.pending.put(serial(address))
+        return ''
+    def replaceDevice(self, interface_id, old_address, new_address):
+        self.alive()
+        self.remove_devices([old_address])
+        self.pending.put(serial(new_address))
+        return ''
+    def readdedDevice(self, interface_id, addresses):
+        self.alive()
+        for addr in addresses:
+            self.pending.put(serial(addr))
+        return ''
+
+class CallbackServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer.SimpleXMLRPCServer):
+    '''
+        xmlrpc server receiving the callbacks of the CCU for <mirror>
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, mirror, host, port):
+        SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(self, (host, port), logRequests=False, allow_none=True)
+        for name in CALLBACKS:
+            self.register_function(getattr(mirror, name), name)
+        self.register_multicall_functions()
+        self.register_introspection_functions()
+
+def run(mirror, callback_url, interface_id, ping_interval=60, resync_interval=86400, save_interval=5):
+    '''
+        Registers <callback_url> at the CCU and keeps <mirror> up to date until interrupted.
+        The CCU is pinged every <ping_interval> seconds. Without answer for three intervals the
+        callback is registered again and the mirror is read completely. A complete read is also
+        done every <resync_interval> seconds.
+        If the CCU can not be reached the mirror is marked as not up to date (so that readers use
+        live calls) and registering or reading is retried with a delay doubling up to <ping_interval>.
+    '''
+    def register():
+        log.info('Registering callback %s at %s', callback_url, mirror.net.rpcaddr)
+        mirror.net.proxy.init(callback_url, interface_id)
+        mirror.full_sync()
+    registered = False
+    delay = retry_at = 0
+    last_ping = last_save = time.time()
+    try:
+        while True:
+            now = time.time()
+            if now < retry_at:
+                time.sleep(min(1.0, retry_at - now))
+            else:
+                try:
+                    if not registered or now - mirror.heartbeat > 3*ping_interval or now - mirror.synced > resync_interval:
+                        registered = False
+                        register()
+                        registered = True
+                    mirror.process()
+                    delay = 0
+                except (xmlrpclib.Fault, xmlrpclib.ProtocolError, socket.error), e:
+                    delay = min(2*delay or 1, ping_interval)
+                    retry_at = time.time() + delay
+                    log.warn('%s failed: %s. Retrying in %.0fs', 'Processing changes' if registered else 'Registering', e, delay)
+                    mirror.failed(e)
+            now = time.time()
+            if now - last_ping > ping_interval:
+                try:
+                    mirror.net.proxy.ping(interface_id)
+                except (xmlrpclib.Fault, socket.error), e:
+                    log.warn('Ping failed: %s', e)
+                last_ping = now
+            if (mirror.dirty or mirror.heartbeat > last_save) and now - last_save > save_interval:
+                mirror.save()
+                last_save = now
+    finally:
+        log.info('Unregistering callback %s', callback_url)
+        mirror.save()
+        try:
+            mirror.net.proxy.init(callback_url, '')
+        except (xmlrpclib.Fault, socket.error), e:
+            log.warn('Unregistering failed: %s', e)
+
+def define_commandline_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-e', '--endpoint', default='ccu:2001', help="host:port of the rpc server of the CCU")
+    parser.add_argument('-l', '--listen', default='0.0.0.0:9123', help="host:port of the local callback server")
+    parser.add_argument('--callback-host', help="Name or address of this host as seen from the CCU (default: fully qualified host name)")
+    parser.add_argument('--cache-dir', default=os.path.expanduser('~/.cache/hmbackup'), help="Directory of the mirror file")
+    parser.add_argument('--mirror-file', help="Mirror file (default: <cache dir>/mirror-<endpoint>.json)")
+    parser.add_argument('-b', '--batch-size', type=int, default=50, help="Number of calls per system.multicall request")
+    parser.add_argument('--ping-interval', type=float, default=60, help="Seconds between pings of the CCU")
+    parser.add_argument('--resync-interval', type=float, default=86400, help="Seconds between complete reads of the CCU")
+    parser.add_argument('-v', '--verbosity', action='count', default=0)
+    return parser
+
+if __name__ == '__main__':
+    import hmnet
+    options = define_commandline_arguments().parse_args()
+    log.basicConfig(format='[%(levelname)s] %(filename)s(%(lineno)s): %(message)s', level=log.DEBUG if options.verbosity else log.INFO)
+    host, port = options.listen.rsplit(':', 1)
+    net = hmnet.network('http://%s'%options.endpoint, '', options.batch_size)
+    mirror = Mirror(net, options.mirror_file or default_filename(options.cache_dir, net.name))
+    server = CallbackServer(mirror, host, int(port))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    callback_url = 'http://%s:%d'%(options.callback_host or socket.getfqdn(), server.server_address[1])
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        run(mirror, callback_url, 'hmbackup-mirror-%s'%socket.gethostname(), options.ping_interval, options.resync_interval)
+    except KeyboardInterrupt:
+        pass
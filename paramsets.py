@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import threading
+import weakref
+from collections import OrderedDict
+
+#Content addressed table of link paramsets
+
+def normalize_value(value):
+    '''
+        Normalizes floats so that values which differ only by rounding noise get the same canonical form
+    '''
+    if type(value) == float:
+        value = round(value, 6)
+        if value == 0.0:
+            value = 0.0
+    return value
+
+def canonical(pset):
+    '''
+        Canonical string representation of paramset <pset> (sorted keys, normalized floats)
+    '''
+    data = dict( (k, normalize_value(v)) for k, v in pset.iteritems() )
+    return json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+def paramset_hash(pset):
+    return hashlib.sha1(canonical(pset)).hexdigest()
+
+class FrozenParamset(dict):
+    '''
+        Immutable paramset. Instances are shared by all links with the same paramset (see intern_paramset).
+        Use dict(pset) to get a modifiable copy.
+    '''
+    __slots__ = ('__weakref__',)
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('Paramset is immutable. Use a copy (dict(pset)) for changes')
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+    def __reduce__(self):
+        return (intern_paramset, (dict(self),))
+
+class ParamsetPool(object):
+    '''
+        Holds one FrozenParamset per distinct paramset as long as it is referenced by any link.
+        Paramsets are compared by their exact values (no normalization).
+    '''
+    def __init__(self):
+        self.paramsets = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+    def intern(self, pset):
+        if pset is None:
+            return None
+        #The type is part of the key because 1, 1.0 and True are equal
+        key = tuple(sorted( (k, type(v).__name__, v) for k, v in pset.iteritems() ))
+        with self.lock:
+            frozen = self.paramsets.get(key)
+            if frozen is None:
+                frozen = FrozenParamset(pset)
+                self.paramsets[key] = frozen
+            return frozen
+    def __len__(self):
+        return len(self.paramsets)
+
+POOL = ParamsetPool()
+
+def intern_paramset(pset):
+    '''
+        Returns the shared immutable FrozenParamset equal to <pset> (None for None)
+    '''
+    return POOL.intern(pset)
+
+class ParamsetTable(object):
+    '''
+        Maps every distinct paramset to an id derived from its content.
+        The ids stay stable across backups. Identical paramsets get the same id.
+        paramsets: OrderedDict of paramsets (sorted by key) by id in the order they were added
+    '''
+    IDLENGTH = 8
+    def __init__(self):
+        self.paramsets = OrderedDict()
+        self.ids = dict()
+        self.frozen = dict()
+    def add(self, pset):
+        '''
+            Adds <pset> if it is not known yet and returns its id.
+            The id of a FrozenParamset is computed only once for all links sharing it.
+        '''
+        if isinstance(pset, FrozenParamset):
+            entry = self.frozen.get(id(pset))
+            if entry is None:
+                #Keep a reference so that the id() is not reused by another object
+                entry = (pset, self.add(dict(pset)))
+                self.frozen[id(pset)] = entry
+            return entry[1]
+        cform = canonical(pset)
+        if cform in self.ids:
+            return self.ids[cform]
+        digest = hashlib.sha1(cform).hexdigest()
+        length = self.IDLENGTH
+        while digest[:length] in self.paramsets:
+            #Collision of shortened hashes
+            length += 4
+        psetid = digest[:length]
+        self.ids[cform] = psetid
+        self.paramsets[psetid] = OrderedDict( (k, pset[k]) for k in sorted(pset) )
+        return psetid
+    def __getitem__(self, psetid):
+        return self.paramsets[psetid]
+    def __contains__(self, psetid):
+        return psetid in self.paramsets
+    def __len__(self):
+        return len(self.paramsets)
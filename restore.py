@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+import logging as log
+import threading
+import time
+import xmlrpclib
+import Queue
+from collections import OrderedDict
+from devices import HMLink, WriteStats
+
+#Plans and applies the restore of a link backup
+
+PENDING_POLL_INTERVAL = 10
+
+class Operation(object):
+    '''
+        A single write operation of a restore
+        action: One of ADD, DELETE or UPDATE
+        link: HMLink the operation acts on. For ADD this is a new link with the paramset to write
+        pset: Paramset from the backup file (None for DELETE)
+        psetid: Reference of the paramset in the backup file
+    '''
+    ADD = 'add'
+    DELETE = 'delete'
+    UPDATE = 'update'
+    def __init__(self, action, link, pset=None, psetid=None):
+        self.action = action
+        self.link = link
+        self.pset = pset
+        self.psetid = psetid
+    def key(self):
+        return (self.link.sender.addr, self.link.receiver.addr)
+    def written_devices(self):
+        '''
+            Devices the operation writes to. Adding and deleting a link also changes the sender.
+        '''
+        if self.action == Operation.UPDATE:
+            return [self.link.receiver]
+        return [self.link.receiver, self.link.sender]
+    def written_serials(self):
+        '''
+            Serial numbers of the devices the operation writes to
+        '''
+        return [dev.addr.split(':')[0] for dev in self.written_devices()]
+    def __unicode__(self):
+        return u'%-6s psetid=%-8s %s'%(self.action, self.psetid, unicode(self.link))
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+    def __repr__(self):
+        return '%s %r'%(self.action, self.link)
+
+class RestorePlan(object):
+    '''
+        All operations needed to bring the network to the state of a backup file.
+        operations: list of Operation in the order of the backup file
+        unchanged: Number of links which are already up to date
+        skipped: Number of backup entries which can not be restored
+        resumed: Number of operations which are done according to the journal of an aborted restore
+        merged: Number of operations by action of plans added with merge()
+    '''
+    def __init__(self):
+        self.operations = list()
+        self.unchanged = 0
+        self.skipped = 0
+        self.resumed = 0
+        self.merged = dict()
+    def count(self, action):
+        return len([op for op in self.operations if op.action == action]) + self.merged.get(action, 0)
+    def merge(self, plan):
+        '''
+            Adds the numbers of <plan> to this plan without keeping its operations
+        '''
+        for action in [Operation.ADD, Operation.DELETE, Operation.UPDATE]:
+            self.merged[action] = self.merged.get(action, 0) + plan.count(action)
+        self.unchanged += plan.unchanged
+        self.skipped += plan.skipped
+        self.resumed += plan.resumed
+    def summary(self):
+        result = '%d to add, %d to delete, %d to update, %d unchanged, %d skipped'%(
+                 self.count(Operation.ADD), self.count(Operation.DELETE), self.count(Operation.UPDATE),
+                 self.unchanged, self.skipped)
+        if self.resumed:
+            result += ', %d done before'%self.resumed
+        return result
+    def skip_done(self, journal, iface):
+        '''
+            Removes all operations which are recorded as done in <journal> for endpoint <iface>
+        '''
+        operations = list()
+        for op in self.operations:
+            if journal.is_done(iface, op):
+                self.resumed += 1
+                continue
+            if journal.was_interrupted(iface, op):
+                log.warn('Operation was interrupted before: %s. Repeating it', op)
+            operations.append(op)
+        self.operations = operations
+    def printout(self, fd, summary=True):
+        for op in self.operations:
+            fd.write(str(op) + '\n')
+        if summary:
+            fd.write(self.summary() + '\n')
+
+def plan_restore(backup, existing_links, devices):
+    '''
+        Computes the RestorePlan for <backup> in one pass over the backup entries
+        backup: Loaded backup file (dict with Linklist and Paramsets)
+        existing_links: list of HMLink present in the network
+        devices: dict of HMDevice by address
+    '''
+    paramsets = backup['Paramsets']
+    existing = dict( ((l.sender.addr, l.receiver.addr), l) for l in existing_links )
+    desired = OrderedDict()
+    plan = RestorePlan()
+    for rlink in backup['Linklist']:
+        key = (rlink['sender'], rlink['receiver'])
+        try:
+            sender = devices[rlink['sender']]
+            receiver = devices[rlink['receiver']]
+        except KeyError, e:
+            log.warn('address %s is not present in network. Check backup file'%e)
+            plan.skipped += 1
+            continue
+        try:
+            pset = paramsets[unicode(rlink['psetid'])]
+        except KeyError, e:
+            log.error('Unknown reference to psetid %s. Check backup file'%(e))
+            plan.skipped += 1
+            continue
+        if key in desired:
+            log.warn('Link %s -> %s is present more than once in backup file. Using last entry'%key)
+        desired[key] = (rlink, sender, receiver, pset)
+
+    for key, (rlink, sender, receiver, pset) in desired.iteritems():
+        existing_link = existing.get(key)
+        if existing_link:
+            if rlink['delete']:
+                #Link is requested to be deleted
+                plan.operations.append(Operation(Operation.DELETE, existing_link, None, rlink['psetid']))
+            elif existing_link.receiver_paramset == pset:
+                plan.unchanged += 1
+            else:
+                #Link does exists ==> update parameters
+                plan.operations.append(Operation(Operation.UPDATE, existing_link, pset, rlink['psetid']))
+        elif rlink['delete']:
+            log.debug('Link does not exist and can not be deleted: %s->%s'%key)
+            plan.unchanged += 1
+        else:
+            #Link does not exist and is not marked for deletion ==> Create link!
+            new_link = HMLink(sender, receiver, pset, 0x00)
+            plan.operations.append(Operation(Operation.ADD, new_link, pset, rlink['psetid']))
+    log.info('Restore plan: %s', plan.summary())
+    return plan
+
+def group_operations(operations):
+    '''
+        Splits <operations> into groups which do not write to a common device (channels of one
+        device count as the same device). Every group keeps the order of <operations>.
+    '''
+    parent = dict()
+    def find(key):
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+    for op in operations:
+        serials = op.written_serials()
+        for serial in serials:
+            parent.setdefault(serial, serial)
+        for serial in serials[1:]:
+            parent[find(serial)] = find(serials[0])
+    groups = OrderedDict()
+    for op in operations:
+        groups.setdefault(find(op.link.receiver.addr.split(':')[0]), list()).append(op)
+    return groups.values()
+
+class OperationResult(object):
+    '''
+        Outcome of an executed Operation
+        seconds: Duration of the operation
+        error: None if the operation succeeded, otherwise the error message
+    '''
+    def __init__(self, op, seconds, error=None):
+        self.op = op
+        self.seconds = seconds
+        self.error = error
+    def ok(self):
+        return self.error is None
+
+class RestoreExecutor(object):
+    '''
+        Executes the operations of a RestorePlan concurrently for different devices.
+        Operations writing to the same device are executed one after another in plan order.
+        At most <max_inflight> radio operations are running at the same time.
+        Writes to sleeping devices (see HMDevice.is_sleeping) block until the device wakes up.
+        Operation groups which write to a sleeping receiver or sender are put into a deferred queue.
+        One background thread works it off whenever no always-on devices are written, so the
+        always-on devices are not held up. A group which writes to a device with operations in the
+        deferred queue (e.g. from an earlier window of stream_restore) is deferred as well, so writes
+        to one device never overlap and keep their order across plans. finish() waits for the
+        deferred queue and checks CONFIG_PENDING of the sleeping devices.
+        timing: [operations, failed, total seconds, max seconds] by action
+        failed: OperationResult of every failed operation. Successful results are only counted in
+                timing, so memory does not grow with the number of operations.
+        pending: Addresses of the sleeping devices which did not receive their configuration yet
+        busy: Number of running or deferred groups by serial number of the written devices
+    '''
+    def __init__(self, net, drymode, max_inflight=1, journal=None):
+        self.net = net
+        self.drymode = drymode
+        self.max_inflight = max(1, max_inflight)
+        self.journal = journal
+        self.timing = dict()
+        self.failed = list()
+        self.stats = WriteStats()
+        self.lock = threading.Lock()
+        self.radio = threading.Semaphore(self.max_inflight)
+        self.idle = threading.Event()
+        self.idle.set()
+        self.deferred = Queue.Queue()
+        self.deferred_thread = None
+        self.sleeping = set()
+        self.pending = list()
+        self.busy = dict()
+    def execute(self, op):
+        with self.radio:
+            return self.execute_locked(op)
+    def execute_locked(self, op):
+        if self.journal is not None:
+            self.journal.started_op(self.net.name, op)
+        start = time.time()
+        error = None
+        try:
+            if op.action == Operation.DELETE:
+                ok = self.net.deleteLink(op.link, self.drymode)
+            elif op.action == Operation.ADD:
+                ok = self.net.addLink(op.link, self.drymode, self.stats)
+            else:
+                op.link.setParamset(op.pset, self.drymode, stats=self.stats)
+                ok = True
+            if not ok:
+                error = 'Communication failure'
+        except Exception, e:
+            error = str(e) or e.__class__.__name__
+        result = OperationResult(op, time.time() - start, error)
+        if self.journal is not None:
+            self.journal.finished_op(self.net.name, op, error)
+        log.debug('%s: %.3fs %s', op, result.seconds, 'ok' if result.ok() else error)
+        with self.lock:
+            timing = self.timing.setdefault(op.action, [0, 0, 0.0, 0.0])
+            timing[0] += 1
+            timing[2] += result.seconds
+            timing[3] = max(timing[3], result.seconds)
+            if not result.ok():
+                timing[1] += 1
+                self.failed.append(result)
+            self.sleeping.update(dev.addr.split(':')[0] for dev in op.written_devices() if dev.is_sleeping())
+        return result
+    def run(self, plan):
+        '''
+            Executes all operations of <plan> on always-on receivers and queues the operations on
+            sleeping receivers
+        '''
+        self.idle.clear()
+        try:
+            self.run_always_on(plan)
+        finally:
+            self.idle.set()
+    def run_always_on(self, plan):
+        start = time.time()
+        receivers = [op.link.receiver for op in plan.operations if op.action != Operation.DELETE]
+        self.net.fetchParamsetInfo(receivers, 'LINK')
+
+        #Operations writing to the same device (receiver or sender) are executed one after another
+        groups = group_operations(plan.operations)
+        todo = Queue.Queue()
+        deferred = 0
+        for ops in groups:
+            sleeping = any(dev.is_sleeping() for op in ops for dev in op.written_devices())
+            with self.lock:
+                #Wait behind deferred operations on the same devices
+                queued = any(serial in self.busy for op in ops for serial in op.written_serials())
+                self.claim(ops)
+            if sleeping or queued:
+                self.defer(ops)
+                deferred += 1
+            else:
+                todo.put(ops)
+        def worker():
+            while True:
+                try:
+                    ops = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    for op in ops:
+                        self.execute(op)
+                finally:
+                    self.release(ops)
+        threads = [threading.Thread(target=worker) for i in range(min(self.max_inflight, todo.qsize()))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        if deferred:
+            log.info('Wrote %d groups of always-on devices in %.1fs, %d groups with sleeping devices are written in the background',
+                     len(groups) - deferred, time.time() - start, deferred)
+    def claim(self, ops):
+        for serial in set(serial for op in ops for serial in op.written_serials()):
+            self.busy[serial] = self.busy.get(serial, 0) + 1
+    def release(self, ops):
+        with self.lock:
+            for serial in set(serial for op in ops for serial in op.written_serials()):
+                self.busy[serial] -= 1
+                if not self.busy[serial]:
+                    del self.busy[serial]
+    def defer(self, ops):
+        self.deferred.put(ops)
+        if self.deferred_thread is None:
+            self.deferred_thread = threading.Thread(target=self.work_deferred)
+            self.deferred_thread.daemon = True
+            self.deferred_thread.start()
+    def work_deferred(self):
+        while True:
+            ops = self.deferred.get()
+            if ops is None:
+                return
+            try:
+                for op in ops:
+                    self.execute_deferred(op)
+            finally:
+                self.release(ops)
+    def execute_deferred(self, op):
+        #Always-on devices first. A run() started while waiting for the radio gets it back
+        while True:
+            self.idle.wait()
+            self.radio.acquire()
+            if self.idle.is_set():
+                break
+            self.radio.release()
+        try:
+            return self.execute_locked(op)
+        finally:
+            self.radio.release()
+    def finish(self, wait_pending=0):
+        '''
+            Waits until the deferred operations are executed and then polls CONFIG_PENDING of the
+            written sleeping devices up to <wait_pending> seconds
+        '''
+        if self.deferred_thread is not None:
+            log.info('Waiting for the writes to sleeping devices')
+            self.deferred.put(None)
+            self.deferred_thread.join()
+            self.deferred_thread = None
+        if not self.drymode and self.sleeping:
+            self.pending = self.poll_pending(wait_pending)
+    def complete(self):
+        '''
+            True if no operation failed
+        '''
+        return not self.failed
+    def poll_pending(self, wait_pending):
+        '''
+            Reads CONFIG_PENDING of the written sleeping devices every PENDING_POLL_INTERVAL seconds until
+            all of them received their configuration or <wait_pending> seconds passed.
+            Returns the addresses of the devices whose configuration is still pending.
+        '''
+        pending = sorted(self.sleeping)
+        deadline = time.time() + wait_pending
+        while True:
+            values = self.net.multicall([('getValue', ('%s:0'%addr, 'CONFIG_PENDING')) for addr in pending])
+            for addr, value in zip(pending, values):
+                if isinstance(value, xmlrpclib.Fault):
+                    log.warn('Can not read CONFIG_PENDING of %s: %s', addr, value)
+            pending = [addr for addr, value in zip(pending, values) if value is True]
+            remaining = deadline - time.time()
+            if not pending or remaining <= 0:
+                return pending
+            log.info('Configuration of %d sleeping devices is pending. Waiting up to %.0fs', len(pending), remaining)
+            time.sleep(min(PENDING_POLL_INTERVAL, remaining))
+    def log_summary(self):
+        for action in [Operation.DELETE, Operation.ADD, Operation.UPDATE]:
+            if action not in self.timing:
+                continue
+            operations, failed, total, longest = self.timing[action]
+            log.info('%-6s %4d operations, %4d failed, %.2fs total, %.3fs mean, %.3fs max',
+                     action, operations, failed, total, total/operations, longest)
+        if self.stats.writes:
+            log.info('Paramset writes: %s', self.stats.summary())
+        for r in self.failed:
+            log.error('Failed: %s (%s)', r.op, r.error)
+        if self.pending:
+            log.warn('Configuration is pending on %d sleeping devices. It is transferred when they wake up '
+                     'or their config button is pressed:', len(self.pending))
+            for addr in self.pending:
+                log.warn('    %s', self.net.devices.get(addr))
+
+def apply_plan(net, plan, drymode, max_inflight=1, journal=None, wait_pending=0):
+    '''
+        Executes all operations of <plan> in <net> and logs a summary.
+        journal: Optional RestoreJournal which records the start and the result of every operation
+        wait_pending: Seconds to wait for sleeping devices to receive their configuration
+        Returns the RestoreExecutor
+    '''
+    executor = RestoreExecutor(net, drymode, max_inflight, journal)
+    executor.run(plan)
+    executor.finish(wait_pending)
+    executor.log_summary()
+    return executor
+
+def stream_restore(net, rlinks, paramsets, drymode, window=1000, max_inflight=1, journal=None, resume=False, plan_fd=None,
+                   wait_pending=0):
+    '''
+        Plans and applies the restore of the backup entries <rlinks> window by window while they are read.
+        Only the devices and links of the receivers of the current window are read from <net>, so
+        the backup is never loaded completely. The links of every receiver are read once and then
+        kept with the state planned for them, so later windows (and entries which are present more
+        than once in the backup) are planned against the result of the earlier windows.
+        rlinks: iterable of backup entries, e.g. BackupReader.links()
+        paramsets: dict like table of the paramsets by psetid, e.g. LazyParamsets
+        window: Number of entries planned and applied at once
+        journal: Optional RestoreJournal. With <resume> operations done according to it are skipped.
+                 In wet mode every operation is recorded in it.
+        plan_fd: If given the operations are written to this file instead of being executed
+        wait_pending: Seconds to wait for sleeping devices to receive their configuration
+        Returns the RestorePlan with the totals of all windows and the RestoreExecutor
+    '''
+    total = RestorePlan()
+    executor = RestoreExecutor(net, drymode, max_inflight, None if drymode else journal)
+    #Links by (sender, receiver) by receiver address as planned by the previous windows
+    known = dict()
+    planned = set()
+    def process(entries):
+        receivers = sorted(set(l['receiver'] for l in entries))
+        unknown = [addr for addr in receivers if addr not in known]
+        for addr in unknown:
+            known[addr] = dict()
+        unknown_set = set(unknown)
+        for link in net.getLinksOf(unknown):
+            if link.receiver.addr in unknown_set:
+                known[link.receiver.addr][(link.sender.addr, link.receiver.addr)] = link
+        existing_links = [link for addr in receivers for link in known[addr].itervalues()]
+        devices = net.getDevicesByAddress(sorted(set(a for l in entries for a in (l['sender'], l['receiver']))))
+        keys = set()
+        for l in entries:
+            key = (l['sender'], l['receiver'])
+            if key in planned and key not in keys:
+                log.warn('Link %s -> %s is present more than once in backup file. Using last entry'%key)
+            keys.add(key)
+        planned.update(keys)
+        plan = plan_restore({'Linklist':entries, 'Paramsets':paramsets}, existing_links, devices)
+        for op in plan.operations:
+            links = known[op.link.receiver.addr]
+            key = (op.link.sender.addr, op.link.receiver.addr)
+            if op.action == Operation.DELETE:
+                del links[key]
+            else:
+                links[key] = HMLink(op.link.sender, op.link.receiver, op.pset, op.link.flags)
+        if resume:
+            plan.skip_done(journal, net.name)
+        if plan_fd is not None:
+            plan.printout(plan_fd, summary=False)
+        else:
+            if journal is not None and not drymode:
+                journal.planned(net.name, plan)
+            executor.run(plan)
+        total.merge(plan)
+    entries = list()
+    for rlink in rlinks:
+        entries.append(rlink)
+        if len(entries) >= window:
+            process(entries)
+            entries = list()
+    if entries:
+        process(entries)
+    executor.finish(wait_pending)
+    log.info('Restore plan of %s: %s', net.name, total.summary())
+    return total, executor
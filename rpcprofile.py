@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+import threading
+import time
+from collections import OrderedDict
+
+#Timing of all rpc calls of a run
+
+FIELDS = ['method', 'target', 'start', 'seconds', 'request_bytes', 'response_bytes', 'error']
+
+def percentile(values, p):
+    '''
+        Nearest rank percentile <p> (0..100) of the sorted list <values>
+    '''
+    if not values:
+        return 0.0
+    idx = int(round(p / 100.0 * (len(values) - 1)))
+    return values[idx]
+
+class RPCProfile(object):
+    '''
+        Records method, target address, latency, payload sizes and errors of every rpc call
+    '''
+    def __init__(self):
+        self.records = list()
+        self.lock = threading.Lock()
+    def record(self, method, target, start, seconds, request_bytes, response_bytes, error=None):
+        with self.lock:
+            self.records.append( (method, target, start, seconds, request_bytes, response_bytes, error) )
+    def record_multicall(self, calls, response, start, seconds, request_bytes, response_bytes, error=None):
+        '''
+            Records every call within one system.multicall request. Each call gets an equal share
+            of the latency and payload of the request.
+            calls: list of {'methodName', 'params'} of the request
+            response: list of results of the request (None if the request failed)
+        '''
+        share = 1.0 / max(1, len(calls))
+        for idx, call in enumerate(calls):
+            params = call.get('params') or []
+            target = params[0] if params and isinstance(params[0], basestring) else ''
+            call_error = error
+            if call_error is None and response is not None and idx < len(response) and type(response[idx]) == dict:
+                call_error = 'Fault'
+            self.record(call['methodName'], target, start, seconds*share, request_bytes*share, response_bytes*share, call_error)
+    def by_method(self):
+        '''
+            Returns OrderedDict of the sorted latencies by method name
+        '''
+        result = OrderedDict()
+        for r in sorted(self.records):
+            result.setdefault(r[0], list()).append(r[3])
+        for seconds in result.values():
+            seconds.sort()
+        return result
+    def slowest_targets(self, count=10):
+        '''
+            Returns the <count> target addresses with the highest total latency as list of
+            (target, calls, total seconds)
+        '''
+        targets = dict()
+        for r in self.records:
+            if not r[1]:
+                continue
+            calls, seconds = targets.get(r[1], (0, 0.0))
+            targets[r[1]] = (calls + 1, seconds + r[3])
+        result = sorted(targets.items(), key=lambda t: t[1][1], reverse=True)[:count]
+        return [(target, calls, seconds) for target, (calls, seconds) in result]
+    def report(self, fd):
+        fd.write('%-24s %7s %7s %9s %9s %9s %11s %11s\n'%('method', 'calls', 'errors', 'p50 [ms]', 'p95 [ms]', 'max [ms]', 'sent [B]', 'recv [B]'))
+        for method, seconds in self.by_method().iteritems():
+            records = [r for r in self.records if r[0] == method]
+            errors = len([r for r in records if r[6]])
+            fd.write('%-24s %7d %7d %9.1f %9.1f %9.1f %11d %11d\n'%(method, len(seconds), errors,
+                     1000*percentile(seconds, 50), 1000*percentile(seconds, 95), 1000*seconds[-1],
+                     sum(r[4] for r in records), sum(r[5] for r in records)))
+        targets = self.slowest_targets()
+        if targets:
+            fd.write('\nSlowest devices:\n')
+            for target, calls, seconds in targets:
+                fd.write('%-24s %7d calls %9.1f ms\n'%(target, calls, 1000*seconds))
+    def dump(self, filename):
+        '''
+            Writes all records to <filename>. The format (csv or json) is chosen by the file extension.
+        '''
+        with open(filename, 'wb') as fd:
+            if filename.lower().endswith('.csv'):
+                writer = csv.writer(fd)
+                writer.writerow(FIELDS)
+                for r in self.records:
+                    writer.writerow([unicode(v).encode('utf-8') if v is not None else '' for v in r])
+            else:
+                json.dump([dict(zip(FIELDS, r)) for r in self.records], fd, indent=1)
+
+class ProfiledMethod(object):
+    '''
+        Callable for the rpc method <name> of a ThreadProxy which records every call in <profile>.
+        The calls of a system.multicall request are recorded one by one.
+    '''
+    def __init__(self, proxy, name, profile):
+        self.proxy = proxy
+        self.name = name
+        self.profile = profile
+    def __getattr__(self, name):
+        return ProfiledMethod(self.proxy, '%s.%s'%(self.name, name), self.profile)
+    def __call__(self, *args):
+        serverproxy, transport = self.proxy.acquire()
+        target = args[0] if args and isinstance(args[0], basestring) else ''
+        error = None
+        result = None
+        start = time.time()
+        try:
+            result = getattr(serverproxy, self.name)(*args)
+            return result
+        except Exception, e:
+            error = e.__class__.__name__
+            raise
+        finally:
+            if self.name == 'system.multicall' and args:
+                #Record the batched calls instead of the batch
+                self.profile.record_multicall(args[0], result, start, time.time() - start,
+                                              transport.last_request_bytes, transport.last_response_bytes, error)
+            else:
+                self.profile.record(self.name, target, start, time.time() - start,
+                                    transport.last_request_bytes, transport.last_response_bytes, error)
+            self.proxy.release( (serverproxy, transport) )
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import json
+import logging as log
+from devices import HMDevice, ParamsetDescriptionCache, check_pset_value
+from backupfile import encode
+
+#Offline validation of backup files against a snapshot of the network
+
+def save_snapshot(net, filename):
+    '''
+        Writes the device descriptions, the LINK paramset descriptions and the current link
+        paramsets of <net> (network object or list of network objects) to the snapshot file <filename>
+    '''
+    snapshot = {'Devices':dict(), 'ParamsetDescriptions':dict(), 'Links':dict()}
+    for n in (net if isinstance(net, list) else [net]):
+        devices = n.getDevices()
+        links = n.getLinks()
+        n.fetchParamsets(links)
+        link_receivers = set(l.receiver.addr for l in links)
+        receivers = [d for d in devices if d.desc.get('DIRECTION') == 2 or d.addr in link_receivers]
+        n.fetchParamsetInfo(receivers, 'LINK')
+
+        for dev in receivers:
+            info = HMDevice.PARAMSET_INFO.get(dev.desc, 'LINK')
+            if info is not None:
+                snapshot['ParamsetDescriptions'][ParamsetDescriptionCache.key(dev.desc, 'LINK')] = info
+        snapshot['Devices'].update( (d.addr, d.desc) for d in devices )
+        snapshot['Links'].update( ('%s|%s'%(l.sender.addr, l.receiver.addr), l.getParamset()) for l in links )
+    with open(filename, 'w') as fd:
+        fd.write(encode(json.dumps(snapshot, ensure_ascii=False)))
+    log.info('Wrote snapshot of %d devices, %d paramset descriptions and %d links to "%s"', len(snapshot['Devices']),
+             len(snapshot['ParamsetDescriptions']), len(snapshot['Links']), filename)
+
+def load_snapshot(filename):
+    with open(filename) as fd:
+        try:
+            return json.load(fd)
+        except ValueError, e:
+            raise EnvironmentError('Error while reading snapshot %s: %s'%(filename, e))
+
+def validate_backup(backup, snapshot):
+    '''
+        Checks all links of <backup> against <snapshot> without any network access.
+        Checked are the presence of the devices and the paramset, the key set of the paramset
+        against the paramset description and every value which differs from the current one
+        (or from the default value for new links) for its type, writability, transform flag and range.
+        Returns the list of problems as (sender, receiver, message) tuples.
+    '''
+    devices = snapshot['Devices']
+    descriptions = snapshot['ParamsetDescriptions']
+    current = snapshot.get('Links', dict())
+    paramsets = backup['Paramsets']
+    problems = list()
+    for rlink in backup['Linklist']:
+        sender, receiver = rlink['sender'], rlink['receiver']
+        def problem(msg):
+            problems.append( (sender, receiver, msg) )
+        missing = [a for a in (sender, receiver) if a not in devices]
+        if missing:
+            problem('Address %s is not present in network'%', '.join(missing))
+            continue
+        if rlink['delete']:
+            continue
+        pset = paramsets.get(unicode(rlink['psetid']))
+        if pset is None:
+            problem('Unknown reference to psetid %s'%rlink['psetid'])
+            continue
+        info = descriptions.get(ParamsetDescriptionCache.key(devices[receiver], 'LINK'))
+        if info is None:
+            problem('No LINK paramset description of receiver type %s in snapshot'%devices[receiver]['TYPE'])
+            continue
+        not_com_keys = set(pset).symmetric_difference(info)
+        if not_com_keys:
+            problem('Keys %s are not common present in device or paramset to put'%', '.join(sorted(not_com_keys)))
+            continue
+        existing = current.get('%s|%s'%(sender, receiver))
+        for key in sorted(pset):
+            old_value = existing[key] if existing is not None else info[key].get('DEFAULT')
+            if pset[key] == old_value:
+                continue
+            if old_value is not None and type(pset[key]) != type(old_value):
+                #The restore refuses to write a value of another type (see HMLink.setParamset)
+                problem('Type %s of parameter %s differs from type %s of the current value'%(
+                        type(pset[key]).__name__, key, type(old_value).__name__))
+                continue
+            msg = check_pset_value(key, pset[key], info[key])
+            if msg:
+                problem(msg)
+    return problems